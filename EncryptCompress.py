@@ -1,122 +1,2597 @@
-#!/usr/bin/env python3
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
-from Crypto.Protocol.KDF import scrypt
-import gzip, bz2, lzma, os, struct
-
-# Constants
-HEADER_MAGIC = b'ENC1'
-SALT_LEN = 16
-NONCE_LEN = 12
-KEY_LEN = 32
-SCRYPT_N = 2**14
-SCRYPT_R = 8
-SCRYPT_P = 1
-
-COMP_METHODS = {
-    'none': 0,
-    'gzip': 1,
-    'bz2': 2,
-    'lzma': 3
-}
-REV_COMP = {v:k for k,v in COMP_METHODS.items()}
-
-def compress_bytes(data, method):
-    if method == 'gzip': return gzip.compress(data)
-    if method == 'bz2': return bz2.compress(data)
-    if method == 'lzma': return lzma.compress(data)
-    return data
-
-def decompress_bytes(data, method):
-    if method == 'gzip': return gzip.decompress(data)
-    if method == 'bz2': return bz2.decompress(data)
-    if method == 'lzma': return lzma.decompress(data)
-    return data
-
-def derive_key(password, salt):
-    return scrypt(password.encode('utf-8'), salt, KEY_LEN, N=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
-
-def encrypt_file(in_path, out_path, password, comp):
-    with open(in_path, 'rb') as f:
-        plaintext = f.read()
-    compressed = compress_bytes(plaintext, comp)
-    salt = get_random_bytes(SALT_LEN)
-    key = derive_key(password, salt)
-    nonce = get_random_bytes(NONCE_LEN)
-    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-    ciphertext, tag = cipher.encrypt_and_digest(compressed)
-    # Header: MAGIC | salt | nonce | tag_len(1) | tag | comp_flag(1) | ciphertext_len(8)
-    with open(out_path, 'wb') as out:
-        out.write(HEADER_MAGIC)
-        out.write(salt)
-        out.write(nonce)
-        out.write(struct.pack('B', len(tag)))
-        out.write(tag)
-        out.write(struct.pack('B', COMP_METHODS[comp]))
-        out.write(struct.pack('>Q', len(ciphertext)))
-        out.write(ciphertext)
-
-def decrypt_file(in_path, out_path, password):
-    with open(in_path, 'rb') as f:
-        magic = f.read(4)
-        if magic != HEADER_MAGIC:
-            raise ValueError("Not a supported encrypted file")
-        salt = f.read(SALT_LEN)
-        nonce = f.read(NONCE_LEN)
-        tag_len = struct.unpack('B', f.read(1))[0]
-        tag = f.read(tag_len)
-        comp_flag = struct.unpack('B', f.read(1))[0]
-        c_len = struct.unpack('>Q', f.read(8))[0]
-        ciphertext = f.read(c_len)
-    key = derive_key(password, salt)
-    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-    compressed = cipher.decrypt_and_verify(ciphertext, tag)
-    comp = REV_COMP.get(comp_flag, 'none')
-    plaintext = decompress_bytes(compressed, comp)
-    with open(out_path, 'wb') as out:
-        out.write(plaintext)
-
-# --- GUI ---
-class App(tk.Tk):
-    def __init__(self):
-        super().__init__()
-        self.title("File Encryptor")
-        self.geometry("480x220")
-        tk.Label(self, text="Password:").pack(anchor='w', padx=10, pady=(10,0))
-        self.pw = tk.Entry(self, show='*', width=40)
-        self.pw.pack(padx=10)
-        tk.Label(self, text="Compression:").pack(anchor='w', padx=10, pady=(10,0))
-        self.comp_var = tk.StringVar(value='none')
-        for opt in COMP_METHODS.keys():
-            tk.Radiobutton(self, text=opt, variable=self.comp_var, value=opt).pack(anchor='w', padx=20)
-        tk.Button(self, text="Encrypt file", command=self.encrypt_action).pack(side='left', padx=20, pady=10)
-        tk.Button(self, text="Decrypt file", command=self.decrypt_action).pack(side='right', padx=20, pady=10)
-
-    def encrypt_action(self):
-        infile = filedialog.askopenfilename(title="Select file to encrypt")
-        if not infile: return
-        outfile = filedialog.asksaveasfilename(title="Save encrypted file as", defaultextension=".enc")
-        if not outfile: return
-        try:
-            encrypt_file(infile, outfile, self.pw.get(), self.comp_var.get())
-            messagebox.showinfo("Done", f"Encrypted to {outfile}")
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
-
-    def decrypt_action(self):
-        infile = filedialog.askopenfilename(title="Select file to decrypt", filetypes=[("Encrypted files","*.enc"),("All files","*.*")])
-        if not infile: return
-        outfile = filedialog.asksaveasfilename(title="Save decrypted file as")
-        if not outfile: return
-        try:
-            decrypt_file(infile, outfile, self.pw.get())
-            messagebox.showinfo("Done", f"Decrypted to {outfile}")
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
-
-
-
-if __name__ == "__main__":
-    App().mainloop()
+#!/usr/bin/env python3
+# tkinter, Crypto and the codec modules are imported where they are used, so the CLI only
+# loads what a given command needs.
+from collections import deque
+import hashlib, hmac, importlib, io, json, math, mmap, os, queue, struct, sys, threading, time, zlib
+
+# Constants
+HEADER_MAGIC = b'ENC1'
+STREAM_MAGIC = b'ENC2'
+FORMAT_VERSION = 9
+SALT_LEN = 16
+NONCE_LEN = 12
+KEY_LEN = 32
+SCRYPT_N = 2**14
+SCRYPT_R = 8
+SCRYPT_P = 1
+DEFAULT_KDF = (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+KDF_MAX_MEMORY = 4 << 30   # refuse headers asking scrypt for more memory than this
+CHUNK_SIZE = 1 << 20
+NONCE_PREFIX_LEN = 8
+TAG_LEN = 16
+WORKERS = os.cpu_count() or 1
+
+# ENC2 header: MAGIC | version(1) | flags(1) | comp_flag(1) | level(1) | chunk_size(4) | nonce_prefix(8) | key block
+# The fields before the key block are bound into every frame as associated data.
+# Version 1 used scrypt(salt) as the data key (key block: salt); version 2 derives a per-file
+# subkey from it with HKDF(key_salt) (key block: salt | key_salt), so files sharing a salt share
+# one scrypt run. Version 3 adds the codec level byte. Version 4 encrypts the data with a random
+# data key that is wrapped by the password-derived key, so the key block can be rewritten in
+# place to change the password:
+# key block: salt(16) | key_salt(16) | wrap_nonce(12) | wrapped_key(32) | wrap_tag(16)
+# Version 5 replaces the single key block with KEY_SLOTS slots of active(1) | key block, so the
+# same data key can be wrapped under several passwords; unused slots hold random bytes.
+# Version 6 records each slot's scrypt parameters: active(1) | log2_N(1) | r(1) | p(1) | key block.
+# Older versions always used SCRYPT_N/R/P.
+# Version 8 appends cipher(1) to the fixed fields, selecting the AEAD used for frames and key
+# slots (see CIPHERS); older versions are always AES-256-GCM.
+# Version 9 appends slot_count(1) after the cipher byte: the header holds that many slots (at most
+# KEY_SLOTS) instead of always KEY_SLOTS, sized to the passwords given plus SPARE_KEY_SLOTS free
+# ones for keyslot add.
+STREAM_PARAMS = struct.Struct('>4sBBBBI8s')
+CIPHERS = {'aes-256-gcm': 0, 'chacha20-poly1305': 1}
+REV_CIPHER = {v: k for k, v in CIPHERS.items()}
+FASTEST_CIPHER = []   # filled by fastest_cipher on first use
+PARAMS_V2 = struct.Struct('>4sBBBI8s')
+KEY_BLOCK = struct.Struct(f'>{SALT_LEN}s{SALT_LEN}s{NONCE_LEN}s{KEY_LEN}s{TAG_LEN}s')
+KEY_SLOTS = 8
+SPARE_KEY_SLOTS = 1
+KDF_PARAMS = struct.Struct('>BBB')
+# Frame: type(1) | ciphertext_len(4) | ciphertext | tag
+FRAME_HEAD = struct.Struct('>BI')
+FRAME_DATA = 0
+FRAME_LAST = 1
+FRAME_INDEX = 2
+FRAME_TOC = 3
+FRAME_VOLUME_END = 4
+# Indexed files follow the last frame with an index frame (nonce counter = chunk count) holding
+# plain_len(8) | frame_offset(8) per chunk, then a footer: index_frame_offset(8) | INDEX_MAGIC
+# From version 7 the index also holds a Merkle root over the data frame tags after plain_len.
+# Archives are indexed files whose plaintext is the concatenation of their members; a TOC frame
+# (zlib-compressed JSON, nonce counter = chunk count) sits between the last frame and the index,
+# which then uses chunk count + 1.
+FLAG_INDEXED = 0x01
+FLAG_ARCHIVE = 0x02
+FLAG_VOLUME = 0x04
+FLAG_DICT = 0x08
+KNOWN_FLAGS = FLAG_INDEXED | FLAG_ARCHIVE | FLAG_VOLUME | FLAG_DICT
+INDEX_MAGIC = b'EIDX'
+FOOTER = struct.Struct('>Q4s')
+# Volume sets (NAME.001, NAME.002, ...) share one data key and nonce counter. Each volume's params
+# end with set_id(16) | volume(4, from 1) | first_frame(4), so every frame is bound to its place
+# in the set, and each volume but the last ends with an empty FRAME_VOLUME_END frame. Volume
+# sets carry no index.
+VOLUME_PARAMS = struct.Struct('>16sII')
+# Files compressed against a shared preset dictionary (FLAG_DICT) append its SHA-256 to the
+# params, after any volume fields. The dictionary itself is stored once per batch, encrypted, as
+# <sha256 hex>.ecdict in the output directory.
+DICT_HASH_LEN = 32
+DICT_SUFFIX = '.ecdict'
+DICT_SIZE = 64 << 10
+DICT_SAMPLE = 4096    # bytes sampled from the start of each input when building a dictionary
+# Resumable encryption keeps a sidecar journal of HMAC'd JSON lines: the first records the input
+# it belongs to, then one checkpoint (chunks, pos) per CHECKPOINT_CHUNKS frames made durable.
+JOURNAL_SUFFIX = '.journal'
+CHECKPOINT_CHUNKS = 64
+# Backup stores hold key.enc (an ENC2 blob of the store's random data and id keys, so rekey and
+# keyslot work on it), chunks/xx/<id> and snapshots/<name>. A chunk's id is HMAC-SHA256(id key,
+# plaintext); chunk and manifest objects are nonce | AES-GCM(auto payload) | tag with the id or
+# snapshot name as AAD. Cut points are where a keyed 32-byte rolling sum has its low 16 bits
+# zero, so chunks average about CDC_MIN + 64 KiB and re-align a few chunks after an edit.
+STORE_KEY = 'key.enc'
+CDC_WINDOW = 32             # power of two, so the rolling sum takes log2(window) shift-and-adds
+CDC_MIN = 512 << 10
+CDC_MAX = 8 << 20
+CDC_SEGMENT = 4 << 20       # bytes scanned for cut points per pool job
+CDC_GAP = 64                # drop candidates this close after another (long runs of one byte)
+
+# Metrics. Each hook is called as hook(stage, seconds, bytes_in, bytes_out) after every KDF run
+# ('kdf'), codec call ('compress:gzip', 'decompress:lzma', ...), AES-GCM or ChaCha20-Poly1305
+# seal/open ('encrypt', 'decrypt') and chunk read or write ('read', 'write'); with no hooks the
+# probes cost one check.
+# Calls made inside process pools are not reported. Memory-mapped inputs are never read()
+# explicitly, so their page faults count towards the stage that first touches the data.
+METRIC_HOOKS = []
+
+def add_metrics_hook(hook):
+    METRIC_HOOKS.append(hook)
+    return hook
+
+def remove_metrics_hook(hook):
+    METRIC_HOOKS.remove(hook)
+
+def metric_start():
+    return time.perf_counter() if METRIC_HOOKS else None
+
+def record(stage, start, bytes_in, bytes_out):
+    if start is not None:
+        seconds = time.perf_counter() - start
+        for hook in METRIC_HOOKS:
+            hook(stage, seconds, bytes_in, bytes_out)
+
+class Stats:
+    # A metrics hook totalling calls, seconds and bytes per stage. Seconds are summed over worker
+    # threads, so with a pool they are busy time and can exceed the wall time of the run.
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, stage, seconds, bytes_in, bytes_out):
+        with self._lock:
+            s = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0})
+            s['calls'] += 1
+            s['seconds'] += seconds
+            s['bytes_in'] += bytes_in
+            s['bytes_out'] += bytes_out
+
+    def as_dict(self):
+        with self._lock:
+            stages = {name: dict(s, mb_s=round(s['bytes_in'] / s['seconds'] / 1e6, 2) if s['seconds'] and s['bytes_in'] else None)
+                      for name, s in sorted(self.stages.items())}
+        return {'wall_seconds': round(time.perf_counter() - self.started, 6), 'stages': stages}
+
+    def prometheus(self, prefix='encryptcompress'):
+        # Prometheus text exposition format, e.g. for node_exporter's textfile collector
+        d, lines = self.as_dict(), []
+        for metric, key, text in (('stage_calls_total', 'calls', "Calls per stage"),
+                                  ('stage_seconds_total', 'seconds', "Seconds per stage, summed over threads"),
+                                  ('stage_bytes_in_total', 'bytes_in', "Bytes into each stage"),
+                                  ('stage_bytes_out_total', 'bytes_out', "Bytes out of each stage")):
+            lines += [f"# HELP {prefix}_{metric} {text}", f"# TYPE {prefix}_{metric} counter"]
+            lines += [f'{prefix}_{metric}{{stage="{stage}"}} {s[key]}' for stage, s in d['stages'].items()]
+        lines += [f"# HELP {prefix}_wall_seconds Wall time of the run", f"# TYPE {prefix}_wall_seconds gauge",
+                  f"{prefix}_wall_seconds {d['wall_seconds']}"]
+        return '\n'.join(lines) + '\n'
+
+# Codec registry. The id is what goes into the comp_flag byte (and, from ENC2 version 3, the
+# level into the byte after it), so ids must never be reused. Codecs backed by optional packages
+# are listed even when the package is missing; using one then fails with a clear error.
+class Codec:
+    # dict_compress(data, level, threads, zdict) / dict_decompress(data, zdict) are given for codecs
+    # that can start from a preset dictionary; multithreaded codecs accept a threads count
+    def __init__(self, name, codec_id, compress, decompress, levels=(0, 0), default_level=0, requires=None,
+                 dict_compress=None, dict_decompress=None, multithreaded=False):
+        self.name, self.id = name, codec_id
+        self.multithreaded = multithreaded
+        self._compress, self._decompress = compress, decompress
+        self.levels, self.default_level = levels, default_level
+        self.requires = requires
+        self._dict_compress, self._dict_decompress = dict_compress, dict_decompress
+
+    def available(self):
+        import importlib.util
+        return self.requires is None or importlib.util.find_spec(self.requires) is not None
+
+    def check(self):
+        if not self.available():
+            raise ValueError(f"Codec {self.name} needs the '{self.requires}' package (pip install {self.requires})")
+
+    def supports_dict(self):
+        return self._dict_compress is not None
+
+    def compress(self, data, level=None, threads=0, zdict=None):
+        self.check()
+        if level is None:
+            level = self.default_level
+        if not self.levels[0] <= level <= self.levels[1]:
+            raise ValueError(f"{self.name} level must be {self.levels[0]}-{self.levels[1]}")
+        if zdict is not None:
+            if not self.supports_dict():
+                raise ValueError(f"Codec {self.name} cannot use a preset dictionary")
+            return self._dict_compress(data, level, threads, zdict)
+        return self._compress(data, level, threads)
+
+    def decompress(self, data, zdict=None):
+        self.check()
+        if zdict is not None:
+            if not self.supports_dict():
+                raise ValueError(f"Codec {self.name} cannot use a preset dictionary")
+            return self._dict_decompress(data, zdict)
+        return self._decompress(data)
+
+CODECS = {}
+COMP_METHODS = {}
+REV_COMP = {}
+
+def register_codec(codec):
+    if codec.id in REV_COMP and REV_COMP[codec.id] != codec.name:
+        raise ValueError(f"Codec id {codec.id} is already used by {REV_COMP[codec.id]}")
+    CODECS[codec.name] = codec
+    COMP_METHODS[codec.name] = codec.id
+    REV_COMP[codec.id] = codec.name
+
+def mod(name):
+    return importlib.import_module(name)
+
+def zstd_compress(data, level, threads):
+    return mod('zstandard').ZstdCompressor(level=level, threads=threads).compress(data)
+
+def zstd_dict(zdict):
+    return mod('zstandard').ZstdCompressionDict(zdict)
+
+# With a dictionary, 'gzip' frames hold raw deflate data primed with the last 32 KiB of it (zdict)
+def deflate_dict(data, level, threads, zdict):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    return c.compress(data) + c.flush()
+
+def inflate_dict(data, zdict):
+    d = zlib.decompressobj(-15, zdict=zdict)
+    return d.decompress(data) + d.flush()
+
+register_codec(Codec('none', 0, lambda d, l, t: d, lambda d: d, dict_compress=lambda d, l, t, z: d, dict_decompress=lambda d, z: d))
+register_codec(Codec('gzip', 1, lambda d, l, t: mod('gzip').compress(d, l), lambda d: mod('gzip').decompress(d), (1, 9), 9,
+                     dict_compress=deflate_dict, dict_decompress=inflate_dict))
+register_codec(Codec('bz2', 2, lambda d, l, t: mod('bz2').compress(d, l), lambda d: mod('bz2').decompress(d), (1, 9), 9))
+register_codec(Codec('lzma', 3, lambda d, l, t: mod('lzma').compress(d, preset=l), lambda d: mod('lzma').decompress(d), (0, 9), 6))
+# 'auto' is resolved per chunk in compress_bytes; its codec functions are never called
+register_codec(Codec('auto', 4, None, None))
+register_codec(Codec('zstd', 5, zstd_compress, lambda d: mod('zstandard').ZstdDecompressor().decompress(d),
+                     (1, 22), 3, requires='zstandard', multithreaded=True,
+                     dict_compress=lambda d, l, t, z: mod('zstandard').ZstdCompressor(level=l, threads=t, dict_data=zstd_dict(z)).compress(d),
+                     dict_decompress=lambda d, z: mod('zstandard').ZstdDecompressor(dict_data=zstd_dict(z)).decompress(d)))
+register_codec(Codec('lz4', 6, lambda d, l, t: mod('lz4.frame').compress(d, compression_level=l),
+                     lambda d: mod('lz4.frame').decompress(d), (0, 16), 0, requires='lz4'))
+
+def parse_codec(spec):
+    # 'name', 'name:level' or 'name:level:threads', e.g. 'gzip:1', 'lzma:9', 'zstd:19:4'
+    name, *rest = spec.split(':')
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name!r} (known: {', '.join(CODECS)})")
+    try:
+        if len(rest) > 2:
+            raise ValueError
+        level = int(rest[0]) if rest and rest[0] else None
+        threads = int(rest[1]) if len(rest) > 1 else 0
+    except ValueError:
+        raise ValueError(f"Bad codec spec {spec!r}; expected name[:level[:threads]]")
+    codec = CODECS[name]
+    if len(rest) > 1 and not codec.multithreaded:
+        raise ValueError(f"{name} takes no threads value; only multithreaded codecs (zstd) do")
+    if level is not None and not codec.levels[0] <= level <= codec.levels[1]:
+        raise ValueError(f"{name} level must be {codec.levels[0]}-{codec.levels[1]}")
+    codec.check()
+    return name, level, threads
+
+def codec_for_flag(comp_flag):
+    if comp_flag not in REV_COMP:
+        raise ValueError(f"Unknown codec id {comp_flag}; the file was written by a newer version")
+    return REV_COMP[comp_flag]
+
+# Leading bytes of formats that are already compressed; recompressing them only burns CPU
+COMPRESSED_MAGICS = (
+    b'\xff\xd8\xff',        # jpeg
+    b'\x89PNG',             # png
+    b'GIF8',                # gif
+    b'PK\x03\x04',          # zip, docx, jar, apk
+    b'\x1f\x8b',            # gzip
+    b'BZh',                 # bz2
+    b'\xfd7zXZ\x00',        # xz
+    b'7z\xbc\xaf\x27\x1c',  # 7z
+    b'Rar!',                # rar
+    b'\x28\xb5\x2f\xfd',    # zstd
+    b'OggS',                # ogg
+    b'fLaC',                # flac
+    b'ID3',                 # mp3
+)
+SAMPLE_BLOCK = 4096
+SAMPLE_BLOCKS = 4
+TEXT_ENTROPY = 5.0  # bits per byte; text and logs sit below this
+
+def looks_compressed(data):
+    data = bytes(data[:12])
+    if data.startswith(COMPRESSED_MAGICS):
+        return True
+    # ISO media (mp4, mov, heic) and RIFF containers (webp, avi) carry their tag at offset 4/8
+    return data[4:8] == b'ftyp' or (data[:4] == b'RIFF' and data[8:12] in (b'WEBP', b'AVI '))
+
+def sample_blocks(data):
+    if len(data) <= SAMPLE_BLOCK * SAMPLE_BLOCKS:
+        return bytes(data)
+    step = (len(data) - SAMPLE_BLOCK) // (SAMPLE_BLOCKS - 1)
+    return b''.join(data[i * step:i * step + SAMPLE_BLOCK] for i in range(SAMPLE_BLOCKS))
+
+def byte_entropy(data):
+    if not data:
+        return 0.0
+    n = len(data)
+    counts = (data.count(b) for b in range(256))
+    return -sum(c / n * math.log2(c / n) for c in counts if c)
+
+def choose_method(data):
+    if len(data) < 64 or looks_compressed(data):
+        return 'none'
+    # A fast zlib trial over a few spread-out blocks decides whether compressing is worth it
+    sample = sample_blocks(data)
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    if ratio > 0.9:
+        return 'none'
+    if ratio > 0.75:
+        return 'gzip'
+    # bz2 does best on text and logs, lzma on everything else that compresses well
+    return 'bz2' if byte_entropy(sample) < TEXT_ENTROPY else 'lzma'
+
+def dict_method():
+    # The codec 'auto' uses for compressible data when a preset dictionary is given
+    return 'zstd' if CODECS['zstd'].available() else 'gzip'
+
+def compress_parts(data, method, zdict=None):
+    # Like compress_bytes, but returns the payload as a list of buffers so the auto tag byte (and
+    # stored chunks) are never copied just to join them; seal_frame encrypts the parts in sequence
+    name, level, threads = parse_codec(method)
+    start = metric_start()
+    if name == 'auto':
+        # Auto output is tagged with the comp_flag actually used; falls back to 'none' if it grew
+        # The trial in choose_method runs without the dictionary, so it would store most small
+        # files that the dictionary shrinks; with one, only data that looks compressed is skipped
+        if zdict is not None:
+            chosen = 'none' if looks_compressed(data) else dict_method()
+        else:
+            chosen = choose_method(data)
+        packed = CODECS[chosen].compress(data, None, 0, zdict)
+        if len(packed) >= len(data):
+            chosen, packed = 'none', data
+        record('compress:' + chosen, start, len(data), len(packed) + 1)
+        return [bytes([COMP_METHODS[chosen]]), packed]
+    packed = CODECS[name].compress(data, level, threads, zdict)
+    record('compress:' + name, start, len(data), len(packed))
+    return [packed]
+
+def compress_bytes(data, method, zdict=None):
+    # method is a codec spec as accepted by parse_codec; zdict is an optional preset dictionary
+    return b''.join(compress_parts(data, method, zdict))
+
+def decompress_bytes(data, method, zdict=None):
+    if method == 'auto':
+        if not data or data[0] not in REV_COMP or REV_COMP[data[0]] == 'auto':
+            raise ValueError("Corrupt auto-compressed data")
+        return decompress_bytes(data[1:], REV_COMP[data[0]], zdict)
+    start = metric_start()
+    plain = CODECS[method].decompress(data, zdict)
+    record('decompress:' + method, start, len(data), len(plain))
+    return plain
+
+def derive_key(password, salt, kdf=None):
+    from Crypto.Protocol.KDF import scrypt
+    n, r, p = kdf or DEFAULT_KDF
+    start = metric_start()
+    key = scrypt(password.encode('utf-8'), salt, KEY_LEN, N=n, r=r, p=p)
+    record('kdf', start, 0, KEY_LEN)
+    return key
+
+def derive_subkey(master, key_salt):
+    from Crypto.Protocol.KDF import HKDF
+    from Crypto.Hash import SHA256
+    return HKDF(master, KEY_LEN, key_salt, SHA256, context=b'ENC2 file key')
+
+def check_kdf(kdf):
+    n, r, p = kdf
+    if n < 2 or n & (n - 1) or n > 1 << 30 or not 1 <= r <= 255 or not 1 <= p <= 255:
+        raise ValueError(f"Invalid scrypt parameters N={n} r={r} p={p}")
+    if 128 * r * n > KDF_MAX_MEMORY:
+        raise ValueError(f"scrypt parameters N={n} r={r} need {128 * r * n >> 20} MiB, over the {KDF_MAX_MEMORY >> 20} MiB limit")
+    return kdf
+
+def calibrate_kdf(target_time=0.25, max_memory=64 << 20, r=SCRYPT_R):
+    # Picks scrypt (N, r, p) that take about target_time seconds on this host without using more
+    # than max_memory bytes: N grows in powers of two up to the memory budget, then p takes up
+    # whatever time is left (p costs time but no extra memory).
+    probe = 1 << 12
+    start = time.perf_counter()
+    derive_key('calibration', b'\0' * SALT_LEN, (probe, r, 1))
+    per_unit = max(time.perf_counter() - start, 1e-6) / probe
+    n = 1 << 10
+    while n * 2 * per_unit <= target_time and 128 * r * n * 2 <= min(max_memory, KDF_MAX_MEMORY) and n < 1 << 30:
+        n *= 2
+    p = max(1, min(255, int(target_time / (n * per_unit))))
+    return check_kdf((n, r, p))
+
+class KeySession:
+    # Caches scrypt master keys per (salt, kdf) for one password. Files encrypted through the same
+    # session share its batch salt, so only the first file pays for the KDF. kdf is the (N, r, p)
+    # used for new key slots; existing files use the parameters recorded in their header.
+    def __init__(self, password, salt=None, kdf=None):
+        self.password = password
+        self.salt = salt or os.urandom(SALT_LEN)
+        self.kdf = check_kdf(tuple(kdf)) if kdf else DEFAULT_KDF
+        self._masters = {}
+        self._lock = threading.Lock()
+
+    def master_key(self, salt, kdf=None):
+        kdf = kdf or self.kdf
+        with self._lock:
+            if (salt, kdf) not in self._masters:
+                self._masters[salt, kdf] = derive_key(self.password, salt, kdf)
+            return self._masters[salt, kdf]
+
+    def file_key(self, salt, key_salt, kdf=None):
+        return derive_subkey(self.master_key(salt, kdf), key_salt)
+
+def as_session(password):
+    return password if isinstance(password, KeySession) else KeySession(password)
+
+def aes_gcm(key, nonce):
+    from Crypto.Cipher import AES
+    return AES.new(key, AES.MODE_GCM, nonce=nonce)
+
+def new_cipher(suite, key, nonce):
+    # Both suites take a 32-byte key and 12-byte nonce and produce 16-byte tags
+    if suite == 'chacha20-poly1305':
+        from Crypto.Cipher import ChaCha20_Poly1305
+        return ChaCha20_Poly1305.new(key=key, nonce=nonce)
+    return aes_gcm(key, nonce)
+
+def params_cipher(params):
+    # The suite a stream's params select, so frame and slot code needs no extra argument
+    return REV_CIPHER[params[STREAM_PARAMS.size]] if params[4] >= 8 else 'aes-256-gcm'
+
+def fastest_cipher():
+    # Times both suites on 256 KiB once per process: AES-GCM wins on CPUs with AES and carry-less
+    # multiply instructions, ChaCha20-Poly1305 (about 3x faster in software) on those without
+    if not FASTEST_CIPHER:
+        data, timings = bytes(256 << 10), {}
+        for suite in CIPHERS:
+            new_cipher(suite, bytes(KEY_LEN), bytes(NONCE_LEN)).encrypt(data[:64])   # imports, warm-up
+            start = time.perf_counter()
+            for _ in range(4):
+                cipher = new_cipher(suite, bytes(KEY_LEN), bytes(NONCE_LEN))
+                cipher.encrypt(data)
+                cipher.digest()
+            timings[suite] = time.perf_counter() - start
+        FASTEST_CIPHER.append(min(timings, key=timings.get))
+    return FASTEST_CIPHER[0]
+
+def check_cipher(cipher):
+    # 'auto' or a CIPHERS name; returns the suite to use
+    if cipher == 'auto':
+        return fastest_cipher()
+    if cipher not in CIPHERS:
+        raise ValueError(f"Unknown cipher {cipher!r} (known: auto, {', '.join(CIPHERS)})")
+    return cipher
+
+def chunk_nonce(prefix, index):
+    if index >= 1 << 32:
+        raise ValueError("Too many chunks for one stream")
+    return prefix + struct.pack('>I', index)
+
+def seal_frame(key, params, prefix, index, ftype, payload):
+    # payload is a buffer or a list of buffers (see compress_parts); they are encrypted straight
+    # into one preallocated frame rather than joined and then concatenated with the head and tag
+    start = metric_start()
+    parts = payload if isinstance(payload, list) else [payload]
+    size = sum(len(part) for part in parts)
+    frame = bytearray(FRAME_HEAD.size + size + TAG_LEN)
+    FRAME_HEAD.pack_into(frame, 0, ftype, size)
+    view = memoryview(frame)
+    cipher = new_cipher(params_cipher(params), key, chunk_nonce(prefix, index))
+    cipher.update(params + frame[:FRAME_HEAD.size])
+    pos = FRAME_HEAD.size
+    for part in parts:
+        if len(part):
+            cipher.encrypt(part, output=view[pos:pos + len(part)])
+            pos += len(part)
+    view[pos:] = cipher.digest()
+    record('encrypt', start, size, len(frame))
+    return frame
+
+def open_frame(key, params, prefix, index, head, ciphertext, tag):
+    start = metric_start()
+    cipher = new_cipher(params_cipher(params), key, chunk_nonce(prefix, index))
+    cipher.update(params + head)
+    if isinstance(ciphertext, memoryview) and not ciphertext.readonly:
+        # The frame buffer belongs to this chunk (see read_frames), so decrypt it in place; the
+        # plaintext is only handed on once verify() accepts the tag
+        cipher.decrypt(ciphertext, output=ciphertext)
+        cipher.verify(tag)
+        plain = ciphertext
+    else:
+        plain = cipher.decrypt_and_verify(ciphertext, tag)
+    record('decrypt', start, len(ciphertext) + TAG_LEN, len(plain))
+    return plain
+
+def seal_chunk(key, params, prefix, index, data, comp, last):
+    payload = compress_parts(data, comp)
+    return seal_frame(key, params, prefix, index, FRAME_LAST if last else FRAME_DATA, payload)
+
+def open_chunk(key, params, prefix, index, head, ciphertext, tag, comp, zdict=None):
+    return decompress_bytes(open_frame(key, params, prefix, index, head, ciphertext, tag), comp, zdict)
+
+def read_chunk(f, n):
+    start = metric_start()
+    data = f.read(n)
+    record('read', start, len(data), len(data))
+    return data
+
+def write_out(f, data):
+    start = metric_start()
+    f.write(data)
+    record('write', start, len(data), len(data))
+
+def read_exact(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ValueError("Truncated encrypted file")
+    return data
+
+def iter_chunks(f, chunk_size):
+    # Yields (data, last) so the final frame can be marked without knowing the size up front
+    data = read_chunk(f, chunk_size)
+    while True:
+        following = read_chunk(f, chunk_size)
+        yield data, not following
+        if not following:
+            return
+        data = following
+
+def iter_views(buf, chunk_size):
+    # iter_chunks over an in-memory buffer or mmap, yielding zero-copy slices
+    view = memoryview(buf)
+    for start in range(0, max(len(view), 1), chunk_size):
+        yield view[start:start + chunk_size], start + chunk_size >= len(view)
+
+def input_chunks(fin, chunk_size, copy=False):
+    # fin is a file object, or a buffer (bytes, mmap) that is sliced instead of read; copy
+    # turns the slices into bytes, which process pools need to pickle them
+    if not isinstance(fin, (bytes, bytearray, memoryview, mmap.mmap)):
+        return iter_chunks(fin, chunk_size)
+    if copy:
+        return ((bytes(data), last) for data, last in iter_views(fin, chunk_size))
+    return iter_views(fin, chunk_size)
+
+def map_input(f):
+    # A read-only mmap of a regular file, so chunks are sliced from the page cache instead of
+    # being copied out by read(); f itself for empty files, pipes and anything else unmappable
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError, io.UnsupportedOperation):
+        return f
+
+def unmap_input(m, f):
+    if m is not f:
+        try:
+            m.close()
+        except BufferError:
+            pass   # a chunk slice is still referenced (e.g. by a traceback); closed when collected
+
+def read_into(f, buf):
+    view, n = memoryview(buf), 0
+    start = metric_start()
+    while n < len(view):
+        got = f.readinto(view[n:])
+        if not got:
+            raise ValueError("Truncated encrypted file")
+        n += got
+    record('read', start, n, n)
+    return buf
+
+def read_frames(f, chunk_size, ends=(FRAME_LAST,)):
+    # Yields (head, ciphertext, tag) up to and including the first frame whose type is in ends
+    max_len = 2 * chunk_size + 4096
+    while True:
+        head = read_exact(f, FRAME_HEAD.size)
+        ftype, c_len = FRAME_HEAD.unpack(head)
+        if (ftype != FRAME_DATA and ftype not in ends) or c_len > max_len:
+            raise ValueError("Corrupt frame header")
+        # One writable buffer per frame, which open_frame then decrypts in place
+        body = memoryview(read_into(f, bytearray(c_len + TAG_LEN)))
+        yield head, body[:c_len], body[c_len:]
+        if ftype != FRAME_DATA:
+            return
+
+def ordered_map(fn, jobs, workers=WORKERS, processes=False):
+    # Runs fn(*job) on a pool and yields results in job order, keeping at most 2*workers in flight
+    if workers <= 1:
+        for job in jobs:
+            yield fn(*job)
+        return
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    pool_cls = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool_cls(max_workers=workers) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.submit(fn, *job))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+PIPELINE_DEPTH = 4
+END = object()
+
+def run_stages(source, stages, sink, depth=PIPELINE_DEPTH):
+    # Overlaps I/O and CPU work: a reader thread drains source, each (fn, workers[, processes])
+    # stage runs on its own thread (fanning out to a pool of `workers` if > 1, results kept in
+    # order; a process pool if the stage asks for one), and sink runs on the calling thread.
+    # Stages are linked by bounded queues, so a slow writer throttles the reader. Sources with
+    # a single item are run inline to skip the thread start-up cost.
+    source = iter(source)
+    head = [item for item in (next(source, END), next(source, END)) if item is not END]
+    if len(head) < 2:
+        for item in head:
+            for fn, *_ in stages:
+                item = fn(item)
+            sink(item)
+        return
+    from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(max(depth, 2 * st[1])) for st in stages]
+    queues.insert(0, queue.Queue(depth))
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            return item.result() if isinstance(item, Future) else item
+        return END
+
+    def guarded(fn):
+        def run():
+            try:
+                fn()
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+        return run
+
+    def read():
+        for item in head:
+            put(queues[0], item)
+        for item in source:
+            if not put(queues[0], item):
+                return
+        put(queues[0], END)
+
+    def stage(fn, workers, inq, outq, processes=False):
+        pool = None
+        if workers > 1:
+            pool = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(max_workers=workers)
+        try:
+            while True:
+                item = get(inq)
+                if item is END:
+                    break
+                if not put(outq, pool.submit(fn, item) if pool else fn(item)):
+                    return
+            put(outq, END)
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=stop.is_set())
+
+    threads = [threading.Thread(target=guarded(read), daemon=True)]
+    for n, st in enumerate(stages):
+        work = lambda st=st, n=n: stage(st[0], st[1], queues[n], queues[n + 1], *st[2:])
+        threads.append(threading.Thread(target=guarded(work), daemon=True))
+    for t in threads:
+        t.start()
+    try:
+        while True:
+            item = get(queues[-1])
+            if item is END:
+                break
+            sink(item)
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
+def compress_job(job):
+    index, data, last, comp, zdict = job
+    return index, compress_parts(data, comp, zdict), last
+
+def decompress_job(job):
+    payload, comp, zdict = job
+    return decompress_bytes(payload, comp, zdict)
+
+def read_stream_header(f, magic=b''):
+    # magic: leading bytes the caller already consumed, so non-seekable inputs can be sniffed
+    head = magic + read_exact(f, 5 - len(magic))
+    if head[:4] != STREAM_MAGIC:
+        raise ValueError("Not a supported encrypted file")
+    version = head[4]
+    if not 1 <= version <= FORMAT_VERSION:
+        raise ValueError(f"Unsupported ENC2 version {version}")
+    layout = STREAM_PARAMS if version >= 3 else PARAMS_V2
+    params = head + read_exact(f, layout.size - len(head))
+    if version >= 3:
+        _, _, flags, comp_flag, level, chunk_size, prefix = layout.unpack(params)
+    else:
+        _, _, flags, comp_flag, chunk_size, prefix = layout.unpack(params)
+        level = None
+    cipher = 'aes-256-gcm'
+    if version >= 8:
+        params += read_exact(f, 1)
+        if params[-1] not in REV_CIPHER:
+            raise ValueError(f"Unknown cipher suite {params[-1]}; the file was written by a newer version")
+        cipher = REV_CIPHER[params[-1]]
+    slot_count = KEY_SLOTS if version >= 5 else 1
+    if version >= 9:
+        params += read_exact(f, 1)
+        slot_count = params[-1]
+        if not 1 <= slot_count <= KEY_SLOTS:
+            raise ValueError("Corrupt ENC2 header")
+    if flags & ~KNOWN_FLAGS:
+        raise ValueError(f"Unsupported ENC2 flags {flags:#x}")
+    if not chunk_size:
+        raise ValueError("Corrupt ENC2 header")
+    hdr = {'version': version, 'flags': flags, 'comp': codec_for_flag(comp_flag),
+           'level': level, 'chunk_size': chunk_size, 'prefix': prefix, 'cipher': cipher}
+    if flags & FLAG_VOLUME:
+        volume = read_exact(f, VOLUME_PARAMS.size)
+        hdr['set_id'], hdr['volume'], hdr['first_frame'] = VOLUME_PARAMS.unpack(volume)
+        params += volume
+    if flags & FLAG_DICT:
+        hdr['dict_hash'] = read_exact(f, DICT_HASH_LEN)
+        params += hdr['dict_hash']
+    hdr['params'] = params
+    if version >= 4:
+        hdr['slots'] = read_slots(f, version, len(params), slot_count)
+        hdr['size'] = len(params) + slots_size(version, slot_count)
+    else:
+        hdr['salt'] = read_exact(f, SALT_LEN)
+        hdr['key_salt'] = read_exact(f, SALT_LEN) if version >= 2 else None
+        hdr['size'] = len(params) + SALT_LEN * (2 if version >= 2 else 1)
+    return hdr
+
+def slot_size(version):
+    return KEY_BLOCK.size + (KDF_PARAMS.size if version >= 6 else 0) + (1 if version >= 5 else 0)
+
+def slots_size(version, count=KEY_SLOTS):
+    return slot_size(version) * (count if version >= 5 else 1)
+
+def read_slots(f, version, offset, count):
+    # Parses the key slots of a version 4+ header into dicts; versions before 6 used the default KDF
+    slots = []
+    for n in range(count):
+        raw = read_exact(f, slot_size(version))
+        slot = {'offset': offset + n * len(raw), 'active': version < 5 or raw[0] == 1, 'kdf': DEFAULT_KDF}
+        if version >= 5:
+            raw = raw[1:]
+        if version >= 6:
+            log_n, r, p = KDF_PARAMS.unpack_from(raw)
+            slot['kdf'] = (1 << log_n, r, p)
+            raw = raw[KDF_PARAMS.size:]
+        slot['salt'], slot['key_salt'], slot['nonce'], slot['wrapped'], slot['tag'] = KEY_BLOCK.unpack(raw)
+        slots.append(slot)
+    return slots
+
+def wrap_key(session, params, data_key):
+    # Returns a version 6 slot body (kdf params | key block) holding data_key wrapped under the session password
+    key_salt = os.urandom(SALT_LEN)
+    nonce = os.urandom(NONCE_LEN)
+    cipher = new_cipher(params_cipher(params), session.file_key(session.salt, key_salt), nonce)
+    cipher.update(params)
+    wrapped, tag = cipher.encrypt_and_digest(data_key)
+    n, r, p = session.kdf
+    return KDF_PARAMS.pack(n.bit_length() - 1, r, p) + KEY_BLOCK.pack(session.salt, key_salt, nonce, wrapped, tag)
+
+def unlock_slot(hdr, password):
+    # Returns (slot number, data key), trying each active slot at the cost of one KDF run each
+    session = as_session(password)
+    if hdr['version'] == 1:
+        return None, session.master_key(hdr['salt'], DEFAULT_KDF)
+    if hdr['version'] < 4:
+        return None, session.file_key(hdr['salt'], hdr['key_salt'], DEFAULT_KDF)
+    for n, slot in enumerate(hdr['slots']):
+        if not slot['active']:
+            continue
+        cipher = new_cipher(hdr['cipher'], session.file_key(slot['salt'], slot['key_salt'], check_kdf(slot['kdf'])), slot['nonce'])
+        cipher.update(hdr['params'])
+        try:
+            return n, cipher.decrypt_and_verify(slot['wrapped'], slot['tag'])
+        except ValueError:
+            pass
+    raise ValueError("Wrong password or corrupt header")
+
+def unlock(hdr, password):
+    return unlock_slot(hdr, password)[1]
+
+def slot_count(passwords, spare_slots=SPARE_KEY_SLOTS):
+    # Slots for a new header: one per password plus spare_slots free ones, at most KEY_SLOTS
+    if passwords > KEY_SLOTS:
+        raise ValueError(f"At most {KEY_SLOTS} passwords per file")
+    if spare_slots < 0:
+        raise ValueError("spare_slots must be 0 or more")
+    return min(passwords + spare_slots, KEY_SLOTS)
+
+def pack_slots(bodies, count):
+    # Builds a table of count slots from wrap_key bodies; the rest are free
+    return b''.join(b'\x01' + b for b in bodies) + b''.join(
+        b'\x00' + os.urandom(slot_size(FORMAT_VERSION) - 1) for _ in range(count - len(bodies)))
+
+def sessions_for(password):
+    # A password, a KeySession, or a list of either (one key slot each)
+    return [as_session(p) for p in password] if isinstance(password, (list, tuple)) else [as_session(password)]
+
+def open_key_slots(f, min_version=4):
+    if f.read(len(HEADER_MAGIC)) == HEADER_MAGIC:
+        raise ValueError("ENC1 files have no key slots; decrypt and re-encrypt them")
+    f.seek(0)
+    hdr = read_stream_header(f)
+    if hdr['version'] < min_version:
+        raise ValueError(f"ENC2 version {hdr['version']} files cannot change passwords in place; decrypt and re-encrypt them")
+    return hdr
+
+def write_slot(f, hdr, n, body, active=True):
+    # Rewrites one slot in place (body as returned by wrap_key); nothing outside the header is touched
+    version = hdr['version']
+    if version < 6:
+        # Older layouts have no room for KDF parameters, so only the default KDF can be stored
+        if active and KDF_PARAMS.unpack_from(body) != (DEFAULT_KDF[0].bit_length() - 1,) + DEFAULT_KDF[1:]:
+            raise ValueError(f"ENC2 version {version} files only support the default scrypt parameters")
+        body = body[KDF_PARAMS.size:]
+    if version >= 5:
+        body = (b'\x01' if active else b'\x00') + body
+    f.seek(hdr['slots'][n]['offset'])
+    f.write(body)
+    f.flush()
+    os.fsync(f.fileno())
+
+def rekey_file(path, old_password, new_password):
+    # Re-wraps the data key under new_password in the slot old_password opened
+    with open(path, 'r+b') as f:
+        hdr = open_key_slots(f)
+        n, key = unlock_slot(hdr, old_password)
+        write_slot(f, hdr, n, wrap_key(as_session(new_password), hdr['params'], key))
+
+def add_key_slot(path, password, new_password):
+    with open(path, 'r+b') as f:
+        hdr = open_key_slots(f, min_version=5)
+        key = unlock(hdr, password)
+        free = [n for n, slot in enumerate(hdr['slots']) if not slot['active']]
+        if not free:
+            raise ValueError(f"All {len(hdr['slots'])} key slots are in use; re-encrypt with more --spare-slots")
+        write_slot(f, hdr, free[0], wrap_key(as_session(new_password), hdr['params'], key))
+        return free[0]
+
+def remove_key_slot(path, password, slot=None):
+    # Removes the slot password opens (or `slot`, after password proves access); the last
+    # remaining slot cannot be removed
+    with open(path, 'r+b') as f:
+        hdr = open_key_slots(f, min_version=5)
+        n, _ = unlock_slot(hdr, password)
+        n = n if slot is None else slot
+        active = [i for i, slot in enumerate(hdr['slots']) if slot['active']]
+        if n not in active:
+            raise ValueError(f"Key slot {n} is not in use")
+        if len(active) == 1:
+            raise ValueError("Refusing to remove the last key slot")
+        write_slot(f, hdr, n, os.urandom(KDF_PARAMS.size + KEY_BLOCK.size), active=False)
+        return n
+
+def stream_header(sessions, params, key):
+    # The slot count is the byte after the cipher in params
+    return params + pack_slots([wrap_key(s, params, key) for s in sessions], params[STREAM_PARAMS.size + 1])
+
+def start_stream(password, comp, chunk_size=CHUNK_SIZE, flags=FLAG_INDEXED, zdict=None, cipher='auto',
+                 spare_slots=SPARE_KEY_SLOTS):
+    # Returns (header bytes, stream state) for a new ENC2 stream with a fresh data key; cipher is
+    # a CIPHERS name or 'auto' for whichever is faster on this host. spare_slots free key slots
+    # are left for keyslot add.
+    if zdict is not None:
+        flags |= FLAG_DICT
+        name = parse_codec(comp)[0]
+        if not CODECS[dict_method() if name == 'auto' else name].supports_dict():
+            raise ValueError(f"Codec {name} cannot use a preset dictionary; use gzip, zstd or auto")
+    sessions = sessions_for(password)
+    prefix = os.urandom(NONCE_PREFIX_LEN)
+    key = os.urandom(KEY_LEN)
+    name, level, _ = parse_codec(comp)
+    level = CODECS[name].default_level if level is None else level
+    params = STREAM_PARAMS.pack(STREAM_MAGIC, FORMAT_VERSION, flags, COMP_METHODS[name], level, chunk_size, prefix)
+    params += bytes([CIPHERS[check_cipher(cipher)], slot_count(len(sessions), spare_slots)])
+    if zdict is not None:
+        params += hashlib.sha256(zdict).digest()
+    header = stream_header(sessions, params, key)
+    state = {'key': key, 'params': params, 'prefix': prefix, 'flags': flags, 'comp': comp, 'zdict': zdict,
+             'chunk_size': chunk_size, 'pos': len(header), 'offsets': [], 'tags': [], 'plain_len': 0}
+    return header, state
+
+def put_frame(fout, state, frame):
+    state['offsets'].append(state['pos'])
+    state['tags'].append(frame[-TAG_LEN:])
+    write_out(fout, frame)
+    state['pos'] += len(frame)
+
+def encrypt_chunks(fin, fout, state, workers=WORKERS, processes=False, on_frame=None):
+    # Encrypts fin to the end as frames numbered on from len(state['offsets']), updating state;
+    # on_frame(index, last) is called after each frame is written
+    key, params, prefix, comp = state['key'], state['params'], state['prefix'], state['comp']
+    first, cs = len(state['offsets']), state['chunk_size']
+    # Pages of a mapped input are dropped once their chunk is written, so RSS stays at about
+    # the chunks in flight rather than growing with the file
+    drop = isinstance(fin, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED')
+
+    def read():
+        for i, (data, last) in enumerate(input_chunks(fin, cs, processes), first):
+            state['plain_len'] += len(data)
+            yield i, data, last, comp, state.get('zdict')
+
+    def seal(job):
+        i, payload, last = job
+        return i, last, seal_frame(key, params, prefix, i, FRAME_LAST if last else FRAME_DATA, payload)
+
+    def write(job):
+        i, last, frame = job
+        put_frame(fout, state, frame)
+        if drop:
+            start = (i - first) * cs
+            fin.madvise(mmap.MADV_DONTNEED, start - start % mmap.PAGESIZE, cs)
+        if on_frame:
+            on_frame(i, last)
+    # read -> compress (pool) -> seal -> write, each overlapping the others
+    run_stages(read(), [(compress_job, workers, processes), (seal, workers)], write)
+
+def finish_stream(fout, state, toc=None):
+    # Writes the archive TOC (if any), the chunk index and the footer after the last frame
+    key, params, prefix, offsets = state['key'], state['params'], state['prefix'], state['offsets']
+    counter, pos = len(offsets), state['pos']
+    if toc:
+        frame = seal_frame(key, params, prefix, counter, FRAME_TOC, toc())
+        fout.write(frame)
+        pos += len(frame)
+        counter += 1
+    if state['flags'] & FLAG_INDEXED:
+        payload = struct.pack(f'>Q32s{len(offsets)}Q', state['plain_len'], merkle_root(state['tags']), *offsets)
+        fout.write(seal_frame(key, params, prefix, counter, FRAME_INDEX, payload))
+        fout.write(FOOTER.pack(pos, INDEX_MAGIC))
+
+def encrypt_stream(fin, fout, password, comp, chunk_size=CHUNK_SIZE, workers=WORKERS, processes=False, index=True, toc=None, zdict=None,
+                   progress=None, cipher='auto', spare_slots=SPARE_KEY_SLOTS):
+    # fin may also be a buffer or mmap, which is sliced instead of read. toc, if given, is called
+    # once all data is read and returns the archive TOC payload. zdict is a shared preset
+    # dictionary (see build_dictionary), referenced from the header by its hash. progress(done)
+    # is called with the plaintext bytes written so far; an exception from it aborts the stream.
+    flags = FLAG_INDEXED | FLAG_ARCHIVE if toc else FLAG_INDEXED if index else 0
+    header, state = start_stream(password, comp, chunk_size, flags, zdict, cipher, spare_slots)
+    fout.write(header)
+
+    def report(i, last):
+        progress(min((i + 1) * chunk_size, state['plain_len']))
+    encrypt_chunks(fin, fout, state, workers, processes, report if progress else None)
+    finish_stream(fout, state, toc)
+
+DICT_CACHE = {}   # sha256 -> dictionary, filled as files that use one are opened
+
+def build_dictionary(paths, size=DICT_SIZE):
+    # Samples the start of each input into a preset dictionary for a batch of small, similar
+    # files: zstd's trainer when zstandard is installed, else the samples themselves (deflate
+    # only uses the last 32 KiB, so later samples count most)
+    samples = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read(DICT_SAMPLE)
+        if data:
+            samples.append(data)
+    if CODECS['zstd'].available() and len(samples) >= 8:
+        try:
+            return mod('zstandard').train_dictionary(size, samples).as_bytes()
+        except mod('zstandard').ZstdError:
+            pass   # too few or too uniform samples to train on
+    return b''.join(samples)[-size:]
+
+def save_dictionary(zdict, directory, password):
+    # Stores zdict encrypted as <sha256 hex>.ecdict in directory unless it is already there, and
+    # returns the path
+    path = os.path.join(directory, hashlib.sha256(zdict).hexdigest() + DICT_SUFFIX)
+    if os.path.exists(path):
+        # Saved by an earlier batch; only its key slots are checked, as the hash is verified on load
+        with open(path, 'rb') as f:
+            hdr = read_stream_header(f)
+        try:
+            for session in sessions_for(password):
+                unlock(hdr, session)
+        except ValueError:
+            raise ValueError(f"{path} exists but does not open with every password given; use another --dict-dir")
+        return path
+    with open(path + '.tmp', 'wb') as f:
+        f.write(encrypt_bytes(zdict, password, 'none', index=False))
+    os.replace(path + '.tmp', path)
+    return path
+
+def load_dictionary(digest, password, dirs):
+    if digest in DICT_CACHE:
+        return DICT_CACHE[digest]
+    name = digest.hex() + DICT_SUFFIX
+    for d in dirs:
+        path = os.path.join(d, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                zdict = decrypt_bytes(f.read(), password)
+            if hashlib.sha256(zdict).digest() != digest:
+                raise ValueError(f"{path} does not match its hash")
+            DICT_CACHE[digest] = zdict
+            return zdict
+    raise ValueError(f"Shared dictionary {name} not found in {', '.join(dirs)}")
+
+def attach_dictionary(hdr, password, dirs):
+    # Sets hdr['zdict'] to the shared dictionary the header refers to, or None
+    hdr['zdict'] = load_dictionary(hdr['dict_hash'], password, dirs) if 'dict_hash' in hdr else None
+    return hdr['zdict']
+
+def dict_search_path(path):
+    # The directory of path and its ancestors, where a batch's .ecdict file is looked for
+    d, dirs = os.path.dirname(os.path.abspath(path)), []
+    while d not in dirs:
+        dirs.append(d)
+        d = os.path.dirname(d)
+    return dirs
+
+def volume_path(path, number):
+    return f"{path}.{number:03d}"
+
+def volume_base(path):
+    # NAME for a volume file NAME.001, NAME.002, ..., else None
+    base, _, number = str(path).rpartition('.')
+    return base if base and len(number) >= 3 and number.isdigit() else None
+
+def encrypt_volumes(fin, out_path, password, comp, volume_size, chunk_size=CHUNK_SIZE, workers=WORKERS, processes=False, progress=None,
+                    cipher='auto', spare_slots=SPARE_KEY_SLOTS):
+    # Writes the stream as out_path.001, .002, ... of at most volume_size bytes each and returns
+    # their paths. A sequential stage places each compressed chunk in a volume as its size
+    # becomes known, so chunks of the next volume are compressed and sealed while the current
+    # one is still being written.
+    sessions = sessions_for(password)
+    header, state = start_stream(sessions, comp, chunk_size, FLAG_VOLUME, cipher=cipher, spare_slots=spare_slots)
+    slots = len(header) - len(state['params'])
+    key, prefix = state['key'], state['prefix']
+    set_id = os.urandom(16)
+    end_size = FRAME_HEAD.size + TAG_LEN
+    vol = {'number': 0, 'params': None, 'room': 0, 'counter': 0}
+    paths, out, chunks = [], [None], [0]
+
+    def read():
+        for i, (data, last) in enumerate(input_chunks(fin, chunk_size, processes)):
+            state['plain_len'] += len(data)
+            yield i, data, last, comp, None
+
+    def place(job):
+        # Returns (first counter, frames); a frame that would not leave room for the end marker
+        # closes the current volume and opens the next
+        _, payload, last = job
+        size = FRAME_HEAD.size + sum(len(part) for part in payload) + TAG_LEN
+        frames = []
+        if vol['params'] is None or size + end_size > vol['room']:
+            if vol['params'] is not None:
+                frames.append((vol['number'], vol['params'], FRAME_VOLUME_END, b''))
+            vol['number'] += 1
+            vol['params'] = state['params'] + VOLUME_PARAMS.pack(set_id, vol['number'], vol['counter'] + len(frames))
+            vol['room'] = volume_size - len(vol['params']) - slots
+            if size + end_size > vol['room']:
+                raise ValueError(f"Volume size {volume_size} is too small for {chunk_size}-byte chunks")
+        vol['room'] -= size
+        frames.append((vol['number'], vol['params'], FRAME_LAST if last else FRAME_DATA, payload))
+        vol['counter'] += len(frames)
+        return vol['counter'] - len(frames), frames
+
+    def seal(job):
+        start, frames = job
+        return [(number, params, seal_frame(key, params, prefix, start + n, ftype, payload))
+                for n, (number, params, ftype, payload) in enumerate(frames)]
+
+    def write(frames):
+        for number, params, frame in frames:
+            if number > len(paths):
+                if out[0]:
+                    out[0].close()
+                paths.append(volume_path(out_path, number))
+                out[0] = open(paths[-1], 'wb')
+                out[0].write(stream_header(sessions, params, key))
+            write_out(out[0], frame)
+        chunks[0] += 1
+        if progress:
+            progress(min(chunks[0] * chunk_size, state['plain_len']))
+    try:
+        run_stages(read(), [(compress_job, workers, processes), (place, 1), (seal, workers)], write)
+    finally:
+        if out[0]:
+            out[0].close()
+    return paths
+
+def volume_frames(f, hdr, key, next_volume):
+    # Yields (params, counter, head, ciphertext, tag) across a volume set, starting after the
+    # header of volume 1 in f; next_volume(n) returns a file positioned at the start of volume n.
+    # Each volume must carry the set id, its own number and the counter the previous one ended on.
+    set_id, counter, number = hdr['set_id'], 0, 1
+    while True:
+        if not hdr['flags'] & FLAG_VOLUME or hdr['set_id'] != set_id or hdr['volume'] != number or hdr['first_frame'] != counter:
+            raise ValueError(f"Expected volume {number} of this set")
+        for head, ciphertext, tag in read_frames(f, hdr['chunk_size'], (FRAME_LAST, FRAME_VOLUME_END)):
+            if head[0] == FRAME_VOLUME_END:
+                open_frame(key, hdr['params'], hdr['prefix'], counter, head, ciphertext, tag)
+            else:
+                yield hdr['params'], counter, head, ciphertext, tag
+            counter += 1
+            if head[0] == FRAME_LAST:
+                return
+        number += 1
+        f = next_volume(number)
+        hdr = read_stream_header(f)
+
+def stream_frames(fin, hdr, key, next_volume=None):
+    # Yields (params, counter, head, ciphertext, tag) for each data frame after the header
+    if hdr['flags'] & FLAG_VOLUME:
+        return volume_frames(fin, hdr, key, next_volume or (lambda n: fin))
+    return ((hdr['params'], i, *frame) for i, frame in enumerate(read_frames(fin, hdr['chunk_size'])))
+
+def decrypt_stream(fin, fout, password, workers=WORKERS, processes=False, next_volume=None, dict_dirs=('.',), progress=None):
+    # Reads strictly forward, so fin and fout may be pipes; output is written chunk by chunk as
+    # each tag verifies, and a missing final frame raises after the preceding chunks were written.
+    # Volume sets continue with next_volume(n), or by default with volumes concatenated in fin.
+    # A shared dictionary the file refers to is looked up in dict_dirs. progress(done) gets the
+    # encrypted bytes consumed by the chunks written so far (ENC1 files report nothing).
+    magic = read_exact(fin, len(HEADER_MAGIC))
+    if magic == HEADER_MAGIC:
+        return decrypt_v1(fin, fout, password)
+    hdr = read_stream_header(fin, magic)
+    if hdr['flags'] & FLAG_ARCHIVE:
+        raise ValueError("This is an archive; use extract_archive")
+    key = unlock(hdr, password)
+    prefix, comp, zdict = hdr['prefix'], hdr['comp'], attach_dictionary(hdr, password, dict_dirs)
+    frames = stream_frames(fin, hdr, key, next_volume)
+    sizes, done = deque(), [0]
+
+    def counted():
+        for job in frames:
+            sizes.append(FRAME_HEAD.size + len(job[3]) + TAG_LEN)
+            yield job
+
+    def write(data):
+        write_out(fout, data)
+        done[0] += sizes.popleft()
+        progress(done[0])
+
+    def unseal(job):
+        params, index, head, ciphertext, tag = job
+        data = open_frame(key, params, prefix, index, head, ciphertext, tag)
+        # Plaintext is decrypted in place in the frame buffer; process pools need it as bytes
+        return bytes(data) if processes else data, comp, zdict
+    # read -> verify/decrypt -> decompress (pool) -> write
+    stages = [(unseal, workers), (decompress_job, workers, processes)]
+    if progress:
+        run_stages(counted(), stages, write)
+    else:
+        run_stages(frames, stages, lambda data: write_out(fout, data))
+
+def merkle_root(tags):
+    # SHA-256 tree over the frame tags: leaves H(0x00 | tag), nodes H(0x01 | left | right), and an
+    # odd node is carried up a level
+    level = [hashlib.sha256(b'\0' + tag).digest() for tag in tags] or [hashlib.sha256(b'').digest()]
+    while len(level) > 1:
+        level = [hashlib.sha256(b'\1' + b''.join(level[i:i + 2])).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+def read_index(f, hdr, key):
+    # Returns (plain_len, frame offsets, Merkle root or None before version 7) from the
+    # authenticated index of a seekable indexed file
+    end = f.seek(0, os.SEEK_END)
+    f.seek(end - FOOTER.size)
+    idx_off, magic = FOOTER.unpack(read_exact(f, FOOTER.size))
+    if magic != INDEX_MAGIC or idx_off < hdr['size']:
+        raise ValueError("Missing chunk index")
+    f.seek(idx_off)
+    head = read_exact(f, FRAME_HEAD.size)
+    ftype, c_len = FRAME_HEAD.unpack(head)
+    if ftype != FRAME_INDEX or c_len < 8 or c_len % 8 or idx_off + FRAME_HEAD.size + c_len + TAG_LEN + FOOTER.size != end:
+        raise ValueError("Corrupt chunk index")
+    rooted = hdr['version'] >= 7
+    count = c_len // 8 - (5 if rooted else 1)
+    if count < 0:
+        raise ValueError("Corrupt chunk index")
+    counter = count + 1 if hdr['flags'] & FLAG_ARCHIVE else count
+    payload = open_frame(key, hdr['params'], hdr['prefix'], counter, head, read_exact(f, c_len), read_exact(f, TAG_LEN))
+    if rooted:
+        plain_len, root, *offsets = struct.unpack(f'>Q32s{count}Q', payload)
+        return plain_len, offsets, root
+    plain_len, *offsets = struct.unpack(f'>Q{count}Q', payload)
+    return plain_len, offsets, None
+
+def scan_offsets(f, hdr):
+    # Walks the frame headers of an unindexed file without decrypting anything
+    offsets, pos = [], hdr['size']
+    while True:
+        f.seek(pos)
+        ftype, c_len = FRAME_HEAD.unpack(read_exact(f, FRAME_HEAD.size))
+        if ftype not in (FRAME_DATA, FRAME_LAST):
+            raise ValueError("Corrupt frame header")
+        offsets.append(pos)
+        pos += FRAME_HEAD.size + c_len + TAG_LEN
+        if ftype == FRAME_LAST:
+            return offsets
+
+def iter_range(f, hdr, key, offsets, offset, length, workers=WORKERS, processes=False):
+    # Yields the plaintext of [offset, offset + length), decrypting only the chunks it overlaps
+    if length <= 0 or not offsets:
+        return
+    cs = hdr['chunk_size']
+    first, last = offset // cs, min((offset + length - 1) // cs, len(offsets) - 1)
+
+    def jobs():
+        for i in range(first, last + 1):
+            f.seek(offsets[i])
+            head = read_exact(f, FRAME_HEAD.size)
+            c_len = FRAME_HEAD.unpack(head)[1]
+            if c_len > 2 * cs + 4096:
+                raise ValueError("Corrupt frame header")
+            yield key, hdr['params'], hdr['prefix'], i, head, read_exact(f, c_len), read_exact(f, TAG_LEN), hdr['comp'], hdr.get('zdict')
+    for i, data in enumerate(ordered_map(open_chunk, jobs(), workers, processes), first):
+        start = max(offset - i * cs, 0)
+        yield data[start:offset + length - i * cs]
+
+def open_range(f, password, workers=WORKERS, processes=False):
+    # Reads the header and chunk offsets of an open ENC2 file; returns (hdr, key, offsets)
+    hdr = read_stream_header(f)
+    if hdr['flags'] & FLAG_VOLUME:
+        raise ValueError("Volume sets have no chunk index; decrypt the whole set")
+    key = unlock(hdr, password)
+    attach_dictionary(hdr, password, dict_search_path(f.name) if isinstance(getattr(f, 'name', None), str) else ('.',))
+    offsets = read_index(f, hdr, key)[1] if hdr['flags'] & FLAG_INDEXED else scan_offsets(f, hdr)
+    return hdr, key, offsets
+
+def decrypt_range(in_path, offset, length, password, workers=WORKERS, processes=False):
+    with open(in_path, 'rb') as f:
+        if f.read(4) == HEADER_MAGIC:
+            raise ValueError("ENC1 files do not support range decryption")
+        f.seek(0)
+        hdr, key, offsets = open_range(f, password)
+        return b''.join(iter_range(f, hdr, key, offsets, offset, length, workers, processes))
+
+def check_frame(key, params, prefix, index, head, ciphertext, tag):
+    # True if the frame authenticates; the plaintext is dropped without being decompressed
+    try:
+        open_frame(key, params, prefix, index, head, ciphertext, tag)
+        return True
+    except ValueError:
+        return False
+
+def verify_file(in_path, password, chunks=None, workers=WORKERS, processes=False):
+    # Checks chunk tags on a pool without writing any plaintext; chunks limits the check to those
+    # chunk numbers. The Merkle root in version 7 indexes is recomputed from every tag on disk
+    # either way (one 16-byte read per chunk), so a subset check still covers the whole file's
+    # tags. Returns {'chunks', 'checked', 'corrupt': merged (start, end) plaintext byte ranges,
+    # 'root': True, False, or None when the file has no root}.
+    with open(in_path, 'rb') as f:
+        if f.read(4) == HEADER_MAGIC:
+            raise ValueError("ENC1 files have no per-chunk tags; decrypt them to verify")
+        f.seek(0)
+        hdr = read_stream_header(f)
+        if hdr['flags'] & FLAG_VOLUME:
+            raise ValueError("Volume sets have no chunk index; decrypt the set to verify it")
+        key = unlock(hdr, password)
+        if hdr['flags'] & FLAG_INDEXED:
+            plain_len, offsets, root = read_index(f, hdr, key)
+        else:
+            offsets, root = scan_offsets(f, hdr), None
+            plain_len = None
+        size = f.seek(0, os.SEEK_END)
+        f.seek(offsets[-1])
+        ends = offsets[1:] + [min(offsets[-1] + FRAME_HEAD.size + FRAME_HEAD.unpack(read_exact(f, FRAME_HEAD.size))[1] + TAG_LEN, size)]
+        wanted = range(len(offsets)) if chunks is None else sorted({i for i in chunks if 0 <= i < len(offsets)})
+
+        def jobs():
+            for i in wanted:
+                f.seek(offsets[i])
+                frame = read_chunk(f, ends[i] - offsets[i])
+                yield key, hdr['params'], hdr['prefix'], i, frame[:FRAME_HEAD.size], frame[FRAME_HEAD.size:-TAG_LEN], frame[-TAG_LEN:]
+        bad = [i for i, ok in zip(wanted, ordered_map(check_frame, jobs(), workers, processes)) if not ok]
+        if root is not None:
+            tags = []
+            for end in ends:
+                f.seek(end - TAG_LEN)
+                tags.append(f.read(TAG_LEN))
+            root = merkle_root(tags) == root
+    cs, corrupt = hdr['chunk_size'], []
+    for i in bad:
+        start, end = i * cs, (i + 1) * cs if plain_len is None else min((i + 1) * cs, plain_len)
+        if corrupt and corrupt[-1][1] == start:
+            corrupt[-1] = (corrupt[-1][0], end)
+        else:
+            corrupt.append((start, end))
+    return {'chunks': len(offsets), 'checked': len(wanted), 'corrupt': corrupt, 'root': root}
+
+class MemberReader:
+    # Presents (path, name) items as one stream and records a TOC entry for each member,
+    # so small members share chunks and compress together
+    def __init__(self, items):
+        self.items = iter(items)
+        self.current = None
+        self.pos = 0
+        self.toc = []
+
+    def read(self, n):
+        out = []
+        while n > 0:
+            if self.current is None:
+                item = next(self.items, None)
+                if item is None:
+                    break
+                path, name = item
+                self.current = open(path, 'rb')
+                self.entry = {'name': name.replace(os.sep, '/'), 'offset': self.pos, 'size': 0,
+                              'mtime': os.fstat(self.current.fileno()).st_mtime}
+                self.toc.append(self.entry)
+            data = self.current.read(n)
+            if not data:
+                self.current.close()
+                self.current = None
+                continue
+            self.entry['size'] += len(data)
+            self.pos += len(data)
+            n -= len(data)
+            out.append(data)
+        return b''.join(out)
+
+    def toc_payload(self):
+        return zlib.compress(json.dumps(self.toc).encode('utf-8'))
+
+def create_archive(items, out_path, password, comp, chunk_size=CHUNK_SIZE, workers=WORKERS, processes=False, cipher='auto',
+                   spare_slots=SPARE_KEY_SLOTS):
+    # items: (path, archive name) pairs, e.g. from expand_inputs
+    reader = MemberReader(items)
+    try:
+        with open(out_path, 'wb') as fout:
+            encrypt_stream(reader, fout, password, comp, chunk_size, workers, processes, toc=reader.toc_payload, cipher=cipher,
+                           spare_slots=spare_slots)
+    except BaseException:
+        remove_partial(out_path)
+        raise
+    finally:
+        if reader.current:
+            reader.current.close()
+    return reader.toc
+
+def read_toc(f, hdr, key, offsets):
+    # The TOC frame directly follows the last data frame
+    f.seek(offsets[-1])
+    toc_off = offsets[-1] + FRAME_HEAD.size + FRAME_HEAD.unpack(read_exact(f, FRAME_HEAD.size))[1] + TAG_LEN
+    f.seek(toc_off)
+    head = read_exact(f, FRAME_HEAD.size)
+    ftype, c_len = FRAME_HEAD.unpack(head)
+    if ftype != FRAME_TOC:
+        raise ValueError("Corrupt archive TOC")
+    payload = open_frame(key, hdr['params'], hdr['prefix'], len(offsets), head, read_exact(f, c_len), read_exact(f, TAG_LEN))
+    return json.loads(zlib.decompress(payload))
+
+def open_archive(f, password):
+    hdr, key, offsets = open_range(f, password)
+    if not hdr['flags'] & FLAG_ARCHIVE:
+        raise ValueError("Not an encrypted archive")
+    return hdr, key, offsets, read_toc(f, hdr, key, offsets)
+
+def list_archive(in_path, password):
+    with open(in_path, 'rb') as f:
+        return open_archive(f, password)[3]
+
+def member_path(out_dir, name):
+    parts = name.split('/')
+    if name.startswith('/') or '..' in parts or not all(parts):
+        raise ValueError(f"Unsafe member name {name!r}")
+    return os.path.join(out_dir, *parts)
+
+def write_members(pieces, entries, out_dir):
+    # Splits one in-order plaintext stream (starting at entries[0]['offset']) into member files
+    pieces = iter(pieces)
+    buf = b''
+    for entry in entries:
+        path = member_path(out_dir, entry['name'])
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        remaining = entry['size']
+        with open(path, 'wb') as out:
+            while remaining:
+                if not buf:
+                    buf = next(pieces, b'')
+                    if not buf:
+                        raise ValueError("Truncated archive data")
+                write_out(out, buf[:remaining])
+                taken = min(remaining, len(buf))
+                buf = buf[taken:]
+                remaining -= taken
+        os.utime(path, (entry['mtime'], entry['mtime']))
+
+def extract_archive(in_path, out_dir, password, names=None, workers=WORKERS, processes=False):
+    # Extracts all members in one pass, or only the named ones by decrypting just their chunks
+    with open(in_path, 'rb') as f:
+        hdr, key, offsets, toc = open_archive(f, password)
+        if names is None:
+            total = sum(e['size'] for e in toc)
+            write_members(iter_range(f, hdr, key, offsets, 0, total, workers, processes), toc, out_dir)
+            return toc
+        wanted = [e for e in toc if e['name'] in set(names)]
+        missing = set(names) - {e['name'] for e in wanted}
+        if missing:
+            raise KeyError(f"Not in archive: {', '.join(sorted(missing))}")
+        for e in wanted:
+            write_members(iter_range(f, hdr, key, offsets, e['offset'], e['size'], workers, processes), [e], out_dir)
+        return wanted
+
+def decrypt_v1(f, fout, password):
+    # ENC1 holds one GCM message, so it is necessarily decrypted in memory; magic already read
+    salt = f.read(SALT_LEN)
+    nonce = f.read(NONCE_LEN)
+    tag_len = struct.unpack('B', f.read(1))[0]
+    tag = f.read(tag_len)
+    comp_flag = struct.unpack('B', f.read(1))[0]
+    c_len = struct.unpack('>Q', f.read(8))[0]
+    ciphertext = f.read(c_len)
+    key = as_session(password).master_key(salt, DEFAULT_KDF)
+    cipher = aes_gcm(key, nonce)
+    compressed = cipher.decrypt_and_verify(ciphertext, tag)
+    comp = REV_COMP.get(comp_flag, 'none')
+    fout.write(decompress_bytes(compressed, comp))
+
+def remove_partial(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def journal_key(key):
+    return hmac.new(key, b'ENC2 journal', hashlib.sha256).digest()
+
+def journal_line(jkey, record):
+    body = json.dumps(record, sort_keys=True).encode()
+    return hmac.new(jkey, body, hashlib.sha256).hexdigest().encode() + b' ' + body + b'\n'
+
+def read_journal(path, jkey):
+    # Returns the records up to the first torn or unauthenticated line
+    records = []
+    with open(path, 'rb') as f:
+        for line in f:
+            mac, _, body = line.rstrip(b'\n').partition(b' ')
+            if not line.endswith(b'\n') or not hmac.compare_digest(mac, hmac.new(jkey, body, hashlib.sha256).hexdigest().encode()):
+                break
+            records.append(json.loads(body))
+    return records
+
+def input_identity(f):
+    st = os.fstat(f.fileno())
+    return [st.st_size, st.st_mtime_ns]
+
+def resume_state(fin, fout, password, journal):
+    # Returns the stream state at the journal's last checkpoint, with fin and fout positioned
+    # to continue, or None if the run died before anything was journalled
+    hdr = read_stream_header(fout)
+    if hdr['version'] != FORMAT_VERSION:
+        return None
+    key = unlock(hdr, password)
+    records = read_journal(journal, journal_key(key))
+    if not records:
+        return None
+    if records[0]['input'] != input_identity(fin):
+        raise ValueError("Input changed since the interrupted run; delete the journal to start over")
+    chunks = records[-1]['chunks'] if len(records) > 1 else 0
+    state = {'key': key, 'params': hdr['params'], 'prefix': hdr['prefix'], 'flags': hdr['flags'],
+             'comp': records[0]['comp'], 'chunk_size': hdr['chunk_size'], 'pos': hdr['size'],
+             'offsets': [], 'tags': [], 'plain_len': chunks * hdr['chunk_size']}
+    while len(state['offsets']) < chunks:
+        fout.seek(state['pos'])
+        ftype, c_len = FRAME_HEAD.unpack(read_exact(fout, FRAME_HEAD.size))
+        if ftype != FRAME_DATA:
+            raise ValueError("Corrupt frame header")
+        fout.seek(c_len, os.SEEK_CUR)
+        state['offsets'].append(state['pos'])
+        state['tags'].append(read_exact(fout, TAG_LEN))
+        state['pos'] += FRAME_HEAD.size + c_len + TAG_LEN
+    if len(records) > 1 and state['pos'] != records[-1]['pos']:
+        raise ValueError("Journal does not match the encrypted file")
+    if chunks:
+        # The checkpoint was written after an fsync, but check the last frame before building on it
+        fout.seek(state['offsets'][-1])
+        head = read_exact(fout, FRAME_HEAD.size)
+        c_len = FRAME_HEAD.unpack(head)[1]
+        open_frame(key, hdr['params'], hdr['prefix'], chunks - 1, head, read_exact(fout, c_len), read_exact(fout, TAG_LEN))
+    fout.seek(state['pos'])
+    fout.truncate()
+    fin.seek(state['plain_len'])
+    return state
+
+def encrypt_file_resumable(in_path, out_path, password, comp, chunk_size=CHUNK_SIZE, workers=WORKERS, processes=False, index=True,
+                           progress=None, cipher='auto', spare_slots=SPARE_KEY_SLOTS):
+    # Like encrypt_file, but journals progress to out_path + JOURNAL_SUFFIX so a crashed or killed
+    # run picks up at its last checkpoint. The partial output is kept on failure for that reason;
+    # the journal is removed once the file is complete.
+    journal = str(out_path) + JOURNAL_SUFFIX
+    resuming = os.path.exists(journal) and os.path.exists(out_path)
+    with open(in_path, 'rb') as fin, open(out_path, 'r+b' if resuming else 'wb') as fout:
+        state = resume_state(fin, fout, password, journal) if resuming else None
+        if state is None:
+            fout.seek(0)
+            fout.truncate()
+            header, state = start_stream(password, comp, chunk_size, FLAG_INDEXED if index else 0, cipher=cipher,
+                                         spare_slots=spare_slots)
+            fout.write(header)
+            sync(fout)
+            with open(journal, 'wb') as j:
+                j.write(journal_line(journal_key(state['key']), {'input': input_identity(fin), 'comp': comp}))
+                sync(j)
+        jkey = journal_key(state['key'])
+        with open(journal, 'ab') as j:
+            def checkpoint(i, last):
+                if progress:
+                    progress(min((i + 1) * chunk_size, state['plain_len']))
+                if last or (i + 1) % CHECKPOINT_CHUNKS:
+                    return
+                sync(fout)
+                j.write(journal_line(jkey, {'chunks': i + 1, 'pos': state['pos']}))
+                sync(j)
+            encrypt_chunks(fin, fout, state, workers, processes, checkpoint)
+            finish_stream(fout, state)
+            sync(fout)
+    os.remove(journal)
+
+def encrypt_file(in_path, out_path, password, comp, chunk_size=CHUNK_SIZE, workers=WORKERS, processes=False, index=True, resume=False, volume_size=None, zdict=None,
+                 progress=None, cipher='auto', spare_slots=SPARE_KEY_SLOTS):
+    # With volume_size, writes out_path.001, .002, ... instead of out_path. progress(done) gets the
+    # plaintext bytes encrypted so far; raising from it cancels the run and, unless resuming,
+    # removes the partial output. A single output file is written as out_path.tmp and renamed over
+    # out_path once complete, so out_path may even be in_path.
+    if zdict is not None and (resume or volume_size):
+        raise ValueError("Shared dictionaries cannot be combined with volumes or resuming")
+    if volume_size:
+        if resume:
+            raise ValueError("Volume sets cannot be resumed")
+        try:
+            with open(in_path, 'rb') as fin:
+                source = map_input(fin)
+                try:
+                    return encrypt_volumes(source, out_path, password, comp, volume_size, chunk_size, workers, processes, progress, cipher,
+                                           spare_slots)
+                finally:
+                    unmap_input(source, fin)
+        except BaseException:
+            number = 1
+            while os.path.exists(volume_path(out_path, number)):
+                remove_partial(volume_path(out_path, number))
+                number += 1
+            raise
+    if resume:
+        if os.path.exists(out_path) and os.path.samefile(in_path, out_path):
+            raise ValueError("Cannot resume encrypting a file onto itself")
+        return encrypt_file_resumable(in_path, out_path, password, comp, chunk_size, workers, processes, index, progress, cipher,
+                                      spare_slots)
+    tmp = str(out_path) + '.tmp'
+    try:
+        with open(in_path, 'rb') as fin, open(tmp, 'wb') as fout:
+            source = map_input(fin)
+            try:
+                encrypt_stream(source, fout, password, comp, chunk_size, workers, processes, index, zdict=zdict, progress=progress, cipher=cipher,
+                               spare_slots=spare_slots)
+            finally:
+                unmap_input(source, fin)
+    except BaseException:
+        remove_partial(tmp)
+        raise
+    os.replace(tmp, out_path)
+
+def decrypt_file(in_path, out_path, password, workers=WORKERS, processes=False, dict_dirs=None, progress=None):
+    # For volume sets pass NAME.001; the following volumes are opened as they are reached. Shared
+    # dictionaries are looked up in dict_dirs, by default the file's directory and its ancestors.
+    # progress is as for decrypt_stream; raising from it cancels and removes the partial output.
+    # The plaintext goes to out_path.tmp and replaces out_path only once every frame verified, so a
+    # wrong password or a corrupt file never touches an existing out_path.
+    base, opened, tmp = volume_base(in_path), [], str(out_path) + '.tmp'
+
+    def next_volume(number):
+        for f in opened:
+            f.close()
+        opened[:] = [open(volume_path(base, number), 'rb')]
+        return opened[0]
+    with open(in_path, 'rb') as f:
+        try:
+            with open(tmp, 'wb') as out:
+                decrypt_stream(f, out, password, workers, processes, next_volume if base else None,
+                               dict_dirs or dict_search_path(in_path), progress)
+        except BaseException:
+            remove_partial(tmp)
+            raise
+        finally:
+            for v in opened:
+                v.close()
+    os.replace(tmp, out_path)
+
+class EncryptedWriter(io.RawIOBase):
+    # Encrypts whatever is written into fileobj as an ENC2 stream, sealing each chunk as soon as
+    # the next byte after it arrives. close() writes the final frame and index but leaves fileobj
+    # open; leaving a with block on an exception skips that, so a failed producer never yields a
+    # stream that looks complete.
+    def __init__(self, fileobj, password, comp='auto', chunk_size=CHUNK_SIZE, index=True, zdict=None, cipher='auto',
+                 spare_slots=SPARE_KEY_SLOTS):
+        self.fileobj = fileobj
+        header, self.state = start_stream(password, comp, chunk_size, FLAG_INDEXED if index else 0, zdict, cipher, spare_slots)
+        fileobj.write(header)
+        self.buffer = bytearray()
+        self.aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("write to closed file")
+        view = memoryview(b).cast('B')
+        n, cs = len(view), self.state['chunk_size']
+        # A full chunk is only sealed once more data follows, since the last one is marked
+        while len(self.buffer) + len(view) > cs:
+            take = cs - len(self.buffer)
+            self.buffer += view[:take]
+            view = view[take:]
+            self.seal(False)
+        self.buffer += view
+        return n
+
+    def seal(self, last):
+        state = self.state
+        i = len(state['offsets'])
+        view = memoryview(self.buffer)
+        frame = seal_frame(state['key'], state['params'], state['prefix'], i,
+                           FRAME_LAST if last else FRAME_DATA, compress_parts(view, state['comp'], state['zdict']))
+        view.release()
+        put_frame(self.fileobj, state, frame)
+        state['plain_len'] += len(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        if not self.closed and not self.aborted:
+            self.seal(True)
+            finish_stream(self.fileobj, self.state)
+            self.fileobj.flush()
+        super().close()
+
+    def __exit__(self, exc_type, *exc):
+        self.aborted = exc_type is not None
+        return super().__exit__(exc_type, *exc)
+
+class EncryptedReader(io.RawIOBase):
+    # Decrypts an ENC2 (or ENC1) stream from fileobj as it is read. Every chunk's tag is checked
+    # before any of its bytes are returned, and a missing final frame raises instead of ending
+    # the stream early. next_volume and dict_dirs are as for decrypt_stream.
+    def __init__(self, fileobj, password, next_volume=None, dict_dirs=('.',)):
+        magic = read_exact(fileobj, len(HEADER_MAGIC))
+        if magic == HEADER_MAGIC:
+            out = io.BytesIO()
+            decrypt_v1(fileobj, out, password)
+            self.chunks = iter([out.getvalue()])
+        else:
+            hdr = read_stream_header(fileobj, magic)
+            if hdr['flags'] & FLAG_ARCHIVE:
+                raise ValueError("This is an archive; use extract_archive")
+            key = unlock(hdr, password)
+            zdict = attach_dictionary(hdr, password, dict_dirs)
+            self.chunks = (decompress_bytes(open_frame(key, params, hdr['prefix'], i, head, ciphertext, tag), hdr['comp'], zdict)
+                           for params, i, head, ciphertext, tag in stream_frames(fileobj, hdr, key, next_volume))
+        self.buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buffer = memoryview(chunk)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+def encrypt_bytes(data, password, comp='auto', chunk_size=CHUNK_SIZE, workers=WORKERS, index=True, cipher='auto',
+                  spare_slots=SPARE_KEY_SLOTS):
+    out = io.BytesIO()
+    encrypt_stream(data, out, password, comp, chunk_size, workers, index=index, cipher=cipher, spare_slots=spare_slots)
+    return out.getvalue()
+
+def decrypt_bytes(data, password, workers=WORKERS):
+    out = io.BytesIO()
+    decrypt_stream(io.BytesIO(data), out, password, workers)
+    return out.getvalue()
+
+# --- Backup store ---
+def cdc_tables(id_key):
+    # Byte -> high/low byte of each position's 16-bit value, keyed so that cut points (and so
+    # chunk sizes) say nothing about the content to anyone without the store key
+    t = hashlib.shake_256(b'ENC2 cdc' + id_key).digest(512)
+    return t[:256], t[256:]
+
+def cdc_candidates(path, start, end, tables):
+    # Offsets in (start, end] of path that follow a byte where the window sum has its low 16 bits
+    # zero. Rather than rolling byte by byte, the values sit in 24-bit lanes of one big int and
+    # the window sums for every position come from log2(CDC_WINDOW) shift-and-adds at C speed.
+    lead = min(start, CDC_WINDOW - 1)
+    with open(path, 'rb') as f:
+        f.seek(start - lead)
+        data = f.read(end - start + lead)
+    lanes = bytearray(3 * len(data))
+    lanes[1::3] = data.translate(tables[0])
+    lanes[2::3] = data.translate(tables[1])
+    s, w = int.from_bytes(lanes, 'big'), 1
+    while w < CDC_WINDOW:
+        s += s >> (24 * w)   # sums stay below 2**21, so lanes never carry into each other
+        w *= 2
+    z = s.to_bytes(len(lanes), 'big')
+    low = bytearray(2 * len(data))
+    low[0::2] = z[1::3]
+    low[1::2] = z[2::3]
+    found, i = [], low.find(b'\0\0', 2 * lead)
+    while i >= 0:
+        if i & 1:
+            i = low.find(b'\0\0', i + 1)
+        else:
+            found.append(start - lead + i // 2 + 1)
+            i = low.find(b'\0\0', i + 2 * CDC_GAP)
+    return found
+
+def cdc_chunks(path, size, tables, workers=WORKERS):
+    # Yields (start, end) of each chunk: the first candidate at least CDC_MIN past the last cut,
+    # else CDC_MAX. Segments are scanned on a process pool, as a candidate only depends on the
+    # window before it.
+    jobs = ((path, a, min(a + CDC_SEGMENT, size), tables) for a in range(0, size, CDC_SEGMENT))
+    pos, candidates = 0, deque()
+    for n, found in enumerate(ordered_map(cdc_candidates, jobs, workers, processes=size > CDC_SEGMENT)):
+        candidates.extend(found)
+        scanned = min(size, (n + 1) * CDC_SEGMENT)
+        while pos < size:
+            while candidates and candidates[0] < pos + CDC_MIN:
+                candidates.popleft()
+            if candidates and candidates[0] <= pos + CDC_MAX:
+                end = candidates.popleft()
+            elif scanned >= min(pos + CDC_MAX, size):
+                end = min(pos + CDC_MAX, size)
+            else:
+                break
+            yield pos, end
+            pos = end
+
+def seal_object(key, aad, parts):
+    start = metric_start()
+    nonce = os.urandom(NONCE_LEN)
+    cipher = aes_gcm(key, nonce)
+    cipher.update(aad)
+    blob = b''.join([nonce] + [cipher.encrypt(part) for part in parts] + [cipher.digest()])
+    record('encrypt', start, len(blob) - NONCE_LEN - TAG_LEN, len(blob))
+    return blob
+
+def open_object(key, aad, blob):
+    if len(blob) < NONCE_LEN + TAG_LEN:
+        raise ValueError("Truncated store object")
+    start = metric_start()
+    cipher = aes_gcm(key, blob[:NONCE_LEN])
+    cipher.update(aad)
+    plain = cipher.decrypt_and_verify(blob[NONCE_LEN:-TAG_LEN], blob[-TAG_LEN:])
+    record('decrypt', start, len(blob), len(plain))
+    return plain
+
+def object_parts(data, comp):
+    # Store objects always lead with the comp_flag byte, so any codec reads back as 'auto'
+    name = parse_codec(comp)[0]
+    parts = compress_parts(data, comp)
+    return parts if name == 'auto' else [bytes([COMP_METHODS[name]])] + parts
+
+def open_store(store, password, create=False):
+    # Returns the store's keys, creating the store first if asked and it does not exist yet
+    path = os.path.join(store, STORE_KEY)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            raw = decrypt_bytes(f.read(), password)
+        if len(raw) != 2 * KEY_LEN:
+            raise ValueError(f"{path} is not a backup store key")
+    elif create:
+        raw = os.urandom(2 * KEY_LEN)
+        os.makedirs(os.path.join(store, 'snapshots'), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(encrypt_bytes(raw, password, 'none', index=False))
+        os.replace(path + '.tmp', path)
+    else:
+        raise FileNotFoundError(f"{store} is not a backup store (no {STORE_KEY})")
+    return {'data': raw[:KEY_LEN], 'id': raw[KEY_LEN:], 'tables': cdc_tables(raw[KEY_LEN:])}
+
+def chunk_path(store, chunk_id):
+    return os.path.join(store, 'chunks', chunk_id[:2], chunk_id)
+
+def put_chunk(store, keys, data, comp):
+    # Stores data unless an identical chunk is already there; returns (id, bytes written)
+    chunk_id = hmac.new(keys['id'], data, hashlib.sha256).hexdigest()
+    path = chunk_path(store, chunk_id)
+    if os.path.exists(path):
+        return chunk_id, 0
+    blob = seal_object(keys['data'], chunk_id.encode(), object_parts(data, comp))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        write_out(f, blob)
+    os.replace(tmp, path)
+    return chunk_id, len(blob)
+
+def get_chunk(store, keys, chunk_id):
+    try:
+        with open(chunk_path(store, chunk_id), 'rb') as f:
+            blob = read_chunk(f, -1)
+    except FileNotFoundError:
+        raise ValueError(f"Chunk {chunk_id} is missing from the store")
+    try:
+        data = decompress_bytes(open_object(keys['data'], chunk_id.encode(), blob), 'auto')
+    except ValueError:
+        raise ValueError(f"Chunk {chunk_id} is corrupt")
+    if not hmac.compare_digest(hmac.new(keys['id'], data, hashlib.sha256).hexdigest(), chunk_id):
+        raise ValueError(f"Chunk {chunk_id} does not match its id")
+    return data
+
+def snapshot_path(store, name):
+    if not name or name.startswith('.') or '/' in name or os.sep in name:
+        raise ValueError(f"Bad snapshot name {name!r}")
+    return os.path.join(store, 'snapshots', name)
+
+def read_snapshot(store, keys, name):
+    with open(snapshot_path(store, name), 'rb') as f:
+        payload = open_object(keys['data'], b'snapshot ' + name.encode(), f.read())
+    return json.loads(decompress_bytes(payload, 'auto'))
+
+def latest_snapshot(store, keys):
+    # The most recently written manifest, whose unchanged files a new snapshot reuses, or None
+    d = os.path.join(store, 'snapshots')
+    names = [n for n in os.listdir(d) if not n.endswith('.tmp')] if os.path.isdir(d) else []
+    if not names:
+        return None
+    return read_snapshot(store, keys, max(names, key=lambda n: os.path.getmtime(os.path.join(d, n))))
+
+def backup_file(path, store, keys, comp, workers=WORKERS):
+    # Returns the file's chunk ids, its size as chunked, and the new chunks and bytes written
+    ids, new, stored, view = [], 0, 0, None
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return ids, size, new, stored
+        source = map_input(f)
+        try:
+            view = memoryview(source)
+            jobs = ((store, keys, view[a:b], comp) for a, b in cdc_chunks(path, size, keys['tables'], workers))
+            for chunk_id, n in ordered_map(put_chunk, jobs, workers):
+                ids.append(chunk_id)
+                new += n > 0
+                stored += n
+        finally:
+            view = None
+            unmap_input(source, f)
+    return ids, size, new, stored
+
+def create_snapshot(items, store, password, comp='auto', name=None, workers=WORKERS):
+    # Backs up (path, name) items into store as one snapshot. Files whose size and mtime match
+    # the latest snapshot reuse its chunk list unread; the rest are chunked and hashed, and only
+    # chunks the store lacks are compressed, encrypted and written.
+    keys = open_store(store, password, create=True)
+    created = time.time()
+    name = name or time.strftime('%Y-%m-%dT%H%M%S', time.localtime(created))
+    path = snapshot_path(store, name)
+    if os.path.exists(path):
+        raise FileExistsError(f"Snapshot {name} already exists")
+    parent = latest_snapshot(store, keys)
+    previous = {e['name']: e for e in parent['files']} if parent else {}
+    files, new, stored = [], 0, 0
+    for item_path, rel in items:
+        st = os.stat(item_path)
+        entry = {'name': rel.replace(os.sep, '/'), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        old = previous.get(entry['name'])
+        if old and (old['size'], old['mtime_ns']) == (entry['size'], entry['mtime_ns']):
+            entry['chunks'] = old['chunks']
+        else:
+            entry['chunks'], entry['size'], n, size = backup_file(item_path, store, keys, comp, workers)
+            new += n
+            stored += size
+        files.append(entry)
+    manifest = {'name': name, 'created': created, 'files': files, 'new_chunks': new, 'stored': stored}
+    body = json.dumps(manifest, separators=(',', ':')).encode()
+    with open(path + '.tmp', 'wb') as f:
+        f.write(seal_object(keys['data'], b'snapshot ' + name.encode(), object_parts(body, 'gzip')))
+    os.replace(path + '.tmp', path)
+    return manifest
+
+def list_snapshots(store, password):
+    keys = open_store(store, password)
+    d = os.path.join(store, 'snapshots')
+    manifests = [read_snapshot(store, keys, n) for n in os.listdir(d) if not n.endswith('.tmp')]
+    return sorted(manifests, key=lambda m: m['created'])
+
+def restore_snapshot(store, name, out_dir, password, names=None, workers=WORKERS):
+    # Restores all files of a snapshot, or only the named ones; every chunk is authenticated and
+    # checked against its id as it is read
+    keys = open_store(store, password)
+    entries = read_snapshot(store, keys, name)['files']
+    if names is not None:
+        wanted = [e for e in entries if e['name'] in set(names)]
+        missing = set(names) - {e['name'] for e in wanted}
+        if missing:
+            raise KeyError(f"Not in snapshot: {', '.join(sorted(missing))}")
+        entries = wanted
+    for e in entries:
+        path = member_path(out_dir, e['name'])
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        written = 0
+        with open(path, 'wb') as out:
+            for data in ordered_map(get_chunk, ((store, keys, c) for c in e['chunks']), workers):
+                write_out(out, data)
+                written += len(data)
+        if written != e['size']:
+            raise ValueError(f"{e['name']}: restored {written} bytes, expected {e['size']}")
+        os.utime(path, ns=(e['mtime_ns'], e['mtime_ns']))
+    return entries
+
+INSPECT_FIELDS = ('path', 'format', 'version', 'cipher', 'comp', 'level', 'chunk_size', 'indexed', 'archive',
+                  'volume', 'dict', 'key_slots', 'kdf', 'size', 'ciphertext_len', 'error')
+
+def inspect_header(path):
+    # Parses only the unencrypted header; no password or Crypto import needed. The header is
+    # fetched with a single unbuffered read of at most the largest header size (under 1 KiB).
+    with open(path, 'rb', buffering=0) as raw:
+        size = os.fstat(raw.fileno()).st_size
+        f = io.BytesIO(raw.read(STREAM_PARAMS.size + 2 + VOLUME_PARAMS.size + DICT_HASH_LEN + slots_size(FORMAT_VERSION)))
+        magic = f.read(4)
+        f.seek(0)
+        if magic == HEADER_MAGIC:
+            f.seek(4 + SALT_LEN + NONCE_LEN)
+            tag_len = read_exact(f, 1)[0]
+            f.seek(tag_len, os.SEEK_CUR)
+            comp_flag, c_len = struct.unpack('>BQ', read_exact(f, 9))
+            return {'path': str(path), 'format': 'ENC1', 'version': 0, 'cipher': 'aes-256-gcm',
+                    'comp': REV_COMP.get(comp_flag, 'none'), 'size': size, 'ciphertext_len': c_len}
+        hdr = read_stream_header(f)
+        return {'path': str(path), 'format': 'ENC2', 'version': hdr['version'], 'cipher': hdr['cipher'],
+                'comp': hdr['comp'], 'level': hdr['level'], 'chunk_size': hdr['chunk_size'],
+                'indexed': bool(hdr['flags'] & FLAG_INDEXED), 'archive': bool(hdr['flags'] & FLAG_ARCHIVE),
+                'volume': hdr.get('volume'), 'dict': hdr['dict_hash'].hex() if 'dict_hash' in hdr else None,
+                'key_slots': sum(1 for slot in hdr['slots'] if slot['active']) if 'slots' in hdr else 1,
+                'kdf': ','.join(f"{n}:{r}:{p}" for n, r, p in
+                                [s['kdf'] for s in hdr.get('slots', []) if s['active']] or [DEFAULT_KDF]),
+                'size': size}
+
+def inspect_entry(path):
+    # inspect_header for bulk audits: unreadable or foreign files become rows with an error
+    try:
+        return inspect_header(path)
+    except (OSError, ValueError, struct.error) as e:
+        return {'path': str(path), 'format': '', 'error': str(e) or type(e).__name__}
+
+def inspect_tree(paths, workers=16):
+    # Yields inspect_entry rows in order for many files, reading headers on a thread pool
+    # (the work is almost all I/O latency, so more threads than cores pays off)
+    yield from ordered_map(inspect_entry, ((p,) for p in paths), workers)
+
+# --- CLI ---
+def expand_inputs(patterns, dir_filter=None):
+    # Yields (path, relative path) for plain files, directory trees and glob patterns. dir_filter,
+    # if given, decides which file names found inside directories are kept; files named directly
+    # or matched by a glob always are.
+    import glob
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise FileNotFoundError(pattern)
+        for match in sorted(matches):
+            if os.path.isdir(match):
+                for root, _, files in os.walk(match):
+                    for name in sorted(files):
+                        if dir_filter and not dir_filter(name):
+                            continue
+                        path = os.path.join(root, name)
+                        yield path, os.path.relpath(path, os.path.dirname(os.path.normpath(match)))
+            else:
+                yield match, os.path.basename(match)
+
+def output_path(path, rel, out_dir, mode):
+    if mode == 'encrypt':
+        name = rel + '.enc'
+    else:
+        name = rel[:-4] if rel.endswith('.enc') else rel + '.dec'
+    if out_dir:
+        return os.path.join(out_dir, name)
+    return os.path.join(os.path.dirname(path), os.path.basename(name))
+
+def read_password_file(path):
+    with open(path, encoding='utf-8') as f:
+        return f.readline().rstrip('\r\n')
+
+def read_password(args, confirm, prompt=True):
+    if args.password_file:
+        return read_password_file(args.password_file)
+    if os.environ.get('ENCRYPTCOMPRESS_PASSWORD'):
+        return os.environ['ENCRYPTCOMPRESS_PASSWORD']
+    if not prompt:
+        raise SystemExit("Streaming from stdin needs --password-file or $ENCRYPTCOMPRESS_PASSWORD")
+    import getpass
+    password = getpass.getpass("Password: ")
+    if confirm and getpass.getpass("Confirm password: ") != password:
+        raise SystemExit("Passwords do not match")
+    return password
+
+def read_new_password(args):
+    if args.new_password_file:
+        return read_password_file(args.new_password_file)
+    if os.environ.get('ENCRYPTCOMPRESS_NEW_PASSWORD'):
+        return os.environ['ENCRYPTCOMPRESS_NEW_PASSWORD']
+    import getpass
+    password = getpass.getpass("New password: ")
+    if getpass.getpass("Confirm new password: ") != password:
+        raise SystemExit("Passwords do not match")
+    return password
+
+def run_jobs(fn, items, jobs):
+    # Runs fn(item) for every item on a thread pool and returns the number of failures
+    from concurrent.futures import ThreadPoolExecutor
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [(item, pool.submit(fn, item)) for item in items]
+        for item, fut in futures:
+            try:
+                fut.result()
+            except Exception as e:
+                failures += 1
+                print(f"{item[0]}: {e}", file=sys.stderr)
+    return failures
+
+def parse_range(text):
+    offset, _, length = text.partition(':')
+    try:
+        offset, length = int(offset), int(length)
+    except ValueError:
+        offset = length = -1
+    if offset < 0 or length < 0:
+        import argparse
+        raise argparse.ArgumentTypeError("expected OFFSET:LENGTH in bytes")
+    return offset, length
+
+def decrypt_range_file(in_path, out_path, offset, length, password, workers=WORKERS):
+    with open(in_path, 'rb') as f:
+        hdr, key, offsets = open_range(f, password)
+        try:
+            with open(out_path, 'wb') as out:
+                for data in iter_range(f, hdr, key, offsets, offset, length, workers):
+                    write_out(out, data)
+        except BaseException:
+            remove_partial(out_path)
+            raise
+
+def parse_size(text):
+    # Bytes, or a number with a K/M/G suffix (powers of 1024), e.g. 18M
+    t = text.strip().upper().removesuffix('B').removesuffix('I')
+    scale = 1 << 10 * ('KMG'.index(t[-1]) + 1) if t[-1:] in ('K', 'M', 'G') else 1
+    try:
+        size = int(float(t.rstrip('KMG')) * scale)
+    except ValueError:
+        size = 0
+    if size <= 0:
+        import argparse
+        raise argparse.ArgumentTypeError("expected a size such as 18M or 1G")
+    return size
+
+def parse_kdf(text):
+    try:
+        n, r, p = (int(x) for x in text.split(':'))
+        return check_kdf((n, r, p))
+    except ValueError as e:
+        import argparse
+        raise argparse.ArgumentTypeError(str(e) if 'scrypt' in str(e) else "expected N:r:p, e.g. 1048576:8:1")
+
+def add_kdf_args(p):
+    p.add_argument('--kdf', type=parse_kdf, metavar='N:r:p', help=f"scrypt parameters for new key slots (default: {SCRYPT_N}:{SCRYPT_R}:{SCRYPT_P})")
+    p.add_argument('--kdf-time', type=float, metavar='SECONDS', help="calibrate scrypt to take about this long on this host")
+    p.add_argument('--kdf-memory', type=int, default=64, metavar='MIB', help="memory budget for --kdf-time (default: 64)")
+
+def kdf_from_args(args):
+    if args.kdf_time:
+        return calibrate_kdf(args.kdf_time, args.kdf_memory << 20)
+    return args.kdf
+
+CODEC_HELP = "codec[:level[:threads]], e.g. gzip:1, lzma:9, zstd:19:4 (default: auto)"
+CIPHER_HELP = "AEAD for the data; auto (default) times both and picks the faster on this host"
+SPARE_SLOTS_HELP = f"free key slots left for keyslot add (default: {SPARE_KEY_SLOTS}; at most {KEY_SLOTS} slots in all)"
+
+def is_encrypted_name(name):
+    # What decrypt picks up inside directories: .enc files and the first volume of a set
+    return name.endswith('.enc') or name.endswith('.001')
+
+def is_plain_name(name):
+    # What encrypt picks up inside directories: anything but this tool's own outputs, i.e. .enc
+    # files, NAME.enc.NNN volumes, resume journals and shared dictionaries
+    base = volume_base(name)
+    return not (name.endswith(('.enc', JOURNAL_SUFFIX, DICT_SUFFIX)) or base and base.endswith('.enc'))
+
+def chunk_size_arg(text):
+    try:
+        size = int(text)
+    except ValueError:
+        size = 0
+    if not 1 <= size <= 1 << 31:
+        import argparse
+        raise argparse.ArgumentTypeError(f"chunk size must be 1 to {1 << 31} bytes")
+    return size
+
+def spare_slots_arg(text):
+    try:
+        count = int(text)
+    except ValueError:
+        count = -1
+    if not 0 <= count < KEY_SLOTS:
+        import argparse
+        raise argparse.ArgumentTypeError(f"spare slots must be 0 to {KEY_SLOTS - 1}")
+    return count
+
+def codec_arg(text):
+    try:
+        parse_codec(text)
+    except ValueError as e:
+        import argparse
+        raise argparse.ArgumentTypeError(str(e))
+    return text
+
+def build_parser():
+    import argparse
+    parser = argparse.ArgumentParser(prog='encryptcompress', description="Compress and encrypt files (run without arguments for the GUI)")
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name in ('encrypt', 'decrypt'):
+        p = sub.add_parser(name)
+        p.add_argument('paths', nargs='+', help="files, directories or glob patterns; '-' streams stdin to stdout")
+        p.add_argument('-o', '--out-dir', help="write outputs here instead of next to the inputs")
+        p.add_argument('--password-file', help="read the password from the first line of this file (default: $ENCRYPTCOMPRESS_PASSWORD or a prompt)")
+        p.add_argument('-j', '--jobs', type=int, default=1, help="files processed concurrently")
+        p.add_argument('-w', '--workers', type=int, help="chunk workers per file (default: CPU count / jobs)")
+        p.add_argument('-f', '--force', action='store_true', help="overwrite existing outputs")
+        if name == 'encrypt':
+            p.add_argument('-c', '--comp', type=codec_arg, default='auto', help=CODEC_HELP)
+            p.add_argument('--cipher', choices=['auto', *CIPHERS], default='auto', help=CIPHER_HELP)
+            p.add_argument('--spare-slots', type=spare_slots_arg, default=SPARE_KEY_SLOTS, help=SPARE_SLOTS_HELP)
+            p.add_argument('--chunk-size', type=chunk_size_arg, default=CHUNK_SIZE)
+            p.add_argument('--no-index', dest='index', action='store_false', help="omit the chunk index used for range decryption")
+            p.add_argument('--volume-size', type=parse_size, metavar='SIZE',
+                           help="split the output into NAME.001, NAME.002, ... of at most SIZE bytes (K/M/G suffixes)")
+            p.add_argument('--shared-dict', action='store_true',
+                           help="compress the batch against one dictionary sampled from its files (best for many small, similar files)")
+            p.add_argument('--resume', action='store_true',
+                           help="journal progress to OUTPUT.journal and continue an interrupted run from it")
+            p.add_argument('--extra-password-file', action='append', default=[],
+                           help="also let this password decrypt the output (one key slot each; repeatable)")
+            add_kdf_args(p)
+        else:
+            p.add_argument('--range', type=parse_range, metavar='OFFSET:LENGTH', help="decrypt only this byte range of the plaintext")
+        p.add_argument('--dict-dir', help="where the shared dictionary is written (encrypt) or also looked for (decrypt; "
+                                          "default: the file's directory and its parents)")
+    p = sub.add_parser('verify', help="check chunk tags and the Merkle root without writing plaintext")
+    p.add_argument('paths', nargs='+', help="files, directories or glob patterns")
+    p.add_argument('--password-file', help="read the password from the first line of this file (default: $ENCRYPTCOMPRESS_PASSWORD or a prompt)")
+    p.add_argument('--range', type=parse_range, metavar='OFFSET:LENGTH', help="only check the chunks holding this plaintext byte range")
+    p.add_argument('-j', '--jobs', type=int, default=1, help="files processed concurrently")
+    p.add_argument('-w', '--workers', type=int, help="chunk workers per file (default: CPU count / jobs)")
+    p = sub.add_parser('inspect', help="print header fields without a password")
+    p.add_argument('paths', nargs='+', help="files, directories or glob patterns")
+    p.add_argument('--format', choices=['text', 'csv', 'json', 'jsonl'], default='text')
+    p.add_argument('-j', '--jobs', type=int, default=16, help="headers read concurrently (default: 16)")
+    p = sub.add_parser('rekey', help="change the password of encrypted files without re-encrypting them")
+    p.add_argument('paths', nargs='+', help="files, directories or glob patterns")
+    p.add_argument('--password-file', help="current password (default: $ENCRYPTCOMPRESS_PASSWORD or a prompt)")
+    p.add_argument('--new-password-file', help="new password (default: $ENCRYPTCOMPRESS_NEW_PASSWORD or a prompt)")
+    p.add_argument('-j', '--jobs', type=int, default=1, help="files processed concurrently")
+    add_kdf_args(p)
+    p = sub.add_parser('keyslot', help="add or remove a password on encrypted files, rewriting only the header")
+    p.add_argument('action', choices=['add', 'remove'])
+    p.add_argument('paths', nargs='+', help="files, directories or glob patterns")
+    p.add_argument('--password-file', help="a password that opens the file (default: $ENCRYPTCOMPRESS_PASSWORD or a prompt)")
+    p.add_argument('--new-password-file', help="password to add (default: $ENCRYPTCOMPRESS_NEW_PASSWORD or a prompt)")
+    p.add_argument('--slot', type=int, help="slot number to remove (default: the slot --password-file opens)")
+    add_kdf_args(p)
+    p = sub.add_parser('calibrate', help="pick scrypt parameters for a target derivation time on this host")
+    p.add_argument('--time', type=float, default=0.25, metavar='SECONDS')
+    p.add_argument('--memory', type=int, default=64, metavar='MIB')
+    p = sub.add_parser('pack', help="pack files and directories into one encrypted archive")
+    p.add_argument('archive')
+    p.add_argument('paths', nargs='+', help="files, directories or glob patterns")
+    p.add_argument('-c', '--comp', type=codec_arg, default='auto', help=CODEC_HELP)
+    p.add_argument('--cipher', choices=['auto', *CIPHERS], default='auto', help=CIPHER_HELP)
+    p.add_argument('--spare-slots', type=spare_slots_arg, default=SPARE_KEY_SLOTS, help=SPARE_SLOTS_HELP)
+    p.add_argument('--chunk-size', type=chunk_size_arg, default=CHUNK_SIZE)
+    add_kdf_args(p)
+    archive_parsers = [p]
+    p = sub.add_parser('list', help="list the members of an encrypted archive")
+    p.add_argument('archive')
+    archive_parsers.append(p)
+    p = sub.add_parser('extract', help="extract all or some members of an encrypted archive")
+    p.add_argument('archive')
+    p.add_argument('names', nargs='*', help="member names (default: all)")
+    p.add_argument('-o', '--out-dir', default='.')
+    archive_parsers.append(p)
+    p = sub.add_parser('backup', help="add a snapshot to a deduplicating backup store (created if missing)")
+    p.add_argument('store')
+    p.add_argument('paths', nargs='+', help="files, directories or glob patterns")
+    p.add_argument('--name', help="snapshot name (default: the current local time)")
+    p.add_argument('-c', '--comp', type=codec_arg, default='auto', help=CODEC_HELP)
+    add_kdf_args(p)
+    archive_parsers.append(p)
+    p = sub.add_parser('snapshots', help="list the snapshots in a backup store")
+    p.add_argument('store')
+    archive_parsers.append(p)
+    p = sub.add_parser('restore', help="restore all or some files of a snapshot")
+    p.add_argument('store')
+    p.add_argument('snapshot')
+    p.add_argument('names', nargs='*', help="file names (default: all)")
+    p.add_argument('-o', '--out-dir', default='.')
+    archive_parsers.append(p)
+    for p in archive_parsers:
+        p.add_argument('--password-file', help="read the password from the first line of this file (default: $ENCRYPTCOMPRESS_PASSWORD or a prompt)")
+        p.add_argument('-w', '--workers', type=int, default=WORKERS, help="chunk workers")
+    for p in sub.choices.values():
+        p.add_argument('--stats', choices=['json', 'prometheus'], help="report time and bytes per stage (KDF, codecs, AES, I/O) at the end")
+        p.add_argument('--stats-file', help="write the --stats report here instead of stderr")
+    return parser
+
+def stream_command(args):
+    # Pipe mode: stdin -> stdout with bounded buffers and no seeking
+    password = read_password(args, confirm=False, prompt=False)
+    if args.command == 'encrypt':
+        kdf = kdf_from_args(args)
+        password = [KeySession(p, kdf=kdf) for p in [password] + [read_password_file(p) for p in args.extra_password_file]]
+    if args.command == 'decrypt' and args.range:
+        raise SystemExit("--range needs a seekable input file")
+    if args.command == 'encrypt' and (args.volume_size or args.resume or args.shared_dict):
+        raise SystemExit("--volume-size, --resume and --shared-dict need output files")
+    workers = args.workers or WORKERS
+    fin, fout = sys.stdin.buffer, sys.stdout.buffer
+    try:
+        if args.command == 'encrypt':
+            encrypt_stream(fin, fout, password, args.comp, args.chunk_size, workers, index=args.index, cipher=args.cipher,
+                           spare_slots=args.spare_slots)
+        else:
+            decrypt_stream(fin, fout, password, workers, dict_dirs=[args.dict_dir or '.'])
+        fout.flush()
+    except (ValueError, OSError) as e:
+        print(f"-: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+def inspect_command(args):
+    # Every volume has its own header, so directories contribute .enc files and all .NNN volumes
+    paths = expand_inputs(args.paths, lambda name: name.endswith('.enc') or volume_base(name))
+    rows = inspect_tree((path for path, _ in paths), args.jobs)
+    errors = 0
+    if args.format == 'csv':
+        import csv
+        writer = csv.DictWriter(sys.stdout, INSPECT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+    elif args.format == 'json':
+        sys.stdout.write('[')
+    for n, row in enumerate(rows):
+        errors += 'error' in row
+        if args.format == 'csv':
+            writer.writerow(row)
+        elif args.format == 'json':
+            sys.stdout.write((',\n' if n else '\n') + json.dumps(row))
+        elif args.format == 'jsonl':
+            print(json.dumps(row))
+        elif 'error' in row:
+            print(f"{row['path']}: {row['error']}", file=sys.stderr)
+        else:
+            print(' '.join(f"{k}={v}" for k, v in row.items()))
+    if args.format == 'json':
+        print('\n]')
+    return 1 if errors else 0
+
+def archive_command(args):
+    password = read_password(args, confirm=args.command == 'pack')
+    if args.command == 'pack':
+        session = KeySession(password, kdf=kdf_from_args(args))
+        toc = create_archive(expand_inputs(args.paths), args.archive, session, args.comp, args.chunk_size, args.workers, cipher=args.cipher,
+                             spare_slots=args.spare_slots)
+        print(f"{len(toc)} members -> {args.archive}")
+    elif args.command == 'list':
+        for e in list_archive(args.archive, password):
+            print(f"{e['size']:>14}  {e['name']}")
+    else:
+        for e in extract_archive(args.archive, args.out_dir, password, args.names or None, args.workers):
+            print(member_path(args.out_dir, e['name']))
+    return 0
+
+def backup_command(args):
+    store_exists = os.path.exists(os.path.join(args.store, STORE_KEY))
+    password = read_password(args, confirm=args.command == 'backup' and not store_exists)
+    if args.command == 'backup':
+        manifest = create_snapshot(expand_inputs(args.paths), args.store, KeySession(password, kdf=kdf_from_args(args)),
+                                   args.comp, args.name, args.workers)
+        total = sum(e['size'] for e in manifest['files'])
+        print(f"{manifest['name']}: {len(manifest['files'])} files, {total} bytes, "
+              f"{manifest['new_chunks']} new chunks ({manifest['stored']} bytes stored)")
+    elif args.command == 'snapshots':
+        for m in list_snapshots(args.store, password):
+            created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(m['created']))
+            print(f"{m['name']}  {created}  {len(m['files'])} files  {sum(e['size'] for e in m['files'])} bytes")
+    else:
+        for e in restore_snapshot(args.store, args.snapshot, args.out_dir, password, args.names or None, args.workers):
+            print(member_path(args.out_dir, e['name']))
+    return 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not args.stats:
+        return run_command(args)
+    stats = add_metrics_hook(Stats())
+    try:
+        return run_command(args)
+    finally:
+        remove_metrics_hook(stats)
+        report = stats.prometheus() if args.stats == 'prometheus' else json.dumps(stats.as_dict(), indent=1) + '\n'
+        if args.stats_file:
+            with open(args.stats_file + '.tmp', 'w') as f:
+                f.write(report)
+            os.replace(args.stats_file + '.tmp', args.stats_file)
+        else:
+            sys.stderr.write(report)
+
+def run_command(args):
+    if args.command == 'calibrate':
+        n, r, p = calibrate_kdf(args.time, args.memory << 20)
+        print(f"{n}:{r}:{p}  ({128 * r * n >> 20} MiB)")
+        return 0
+    if args.command == 'inspect':
+        return inspect_command(args)
+    if args.command in ('pack', 'list', 'extract'):
+        return archive_command(args)
+    if args.command in ('backup', 'snapshots', 'restore'):
+        return backup_command(args)
+    if args.command == 'verify':
+        session = KeySession(read_password(args, confirm=False))
+        workers = args.workers or max(1, WORKERS // max(1, args.jobs))
+
+        def verify(item):
+            chunks = None
+            if args.range:
+                cs = inspect_header(item[0]).get('chunk_size') or 1
+                offset, length = args.range
+                chunks = range(offset // cs, (offset + max(length, 1) - 1) // cs + 1)
+            result = verify_file(item[0], session, chunks, workers)
+            if result['corrupt']:
+                raise ValueError("corrupt plaintext bytes " + ', '.join(f"{a}-{b}" for a, b in result['corrupt']))
+            if result['root'] is False:
+                raise ValueError("chunk tags do not match the Merkle root")
+            print(f"{item[0]}: ok ({result['checked']}/{result['chunks']} chunks, {'root ok' if result['root'] else 'no root'})")
+        return 1 if run_jobs(verify, list(expand_inputs(args.paths, is_encrypted_name)), args.jobs) else 0
+    if args.command == 'rekey':
+        old = KeySession(read_password(args, confirm=False))
+        new = KeySession(read_new_password(args), kdf=kdf_from_args(args))
+
+        def rekey(item):
+            rekey_file(item[0], old, new)
+            print(f"{item[0]}: re-keyed")
+        return 1 if run_jobs(rekey, list(expand_inputs(args.paths)), args.jobs) else 0
+    if args.command == 'keyslot':
+        session = KeySession(read_password(args, confirm=False))
+        new = KeySession(read_new_password(args), kdf=kdf_from_args(args)) if args.action == 'add' else None
+
+        def change(item):
+            if new:
+                print(f"{item[0]}: added slot {add_key_slot(item[0], session, new)}")
+            else:
+                print(f"{item[0]}: removed slot {remove_key_slot(item[0], session, args.slot)}")
+        return 1 if run_jobs(change, list(expand_inputs(args.paths)), 1) else 0
+    if args.paths == ['-']:
+        return stream_command(args)
+    items = list(expand_inputs(args.paths, is_encrypted_name if args.command == 'decrypt' else is_plain_name))
+    kdf = kdf_from_args(args) if args.command == 'encrypt' else None
+    session = KeySession(read_password(args, confirm=args.command == 'encrypt'), kdf=kdf)
+    if args.command == 'encrypt' and args.extra_password_file:
+        session = [session] + [KeySession(read_password_file(p), kdf=kdf) for p in args.extra_password_file]
+    workers = args.workers or max(1, WORKERS // max(1, args.jobs))
+    zdict = None
+    if args.command == 'encrypt' and args.shared_dict:
+        zdict = build_dictionary(path for path, _ in items)
+        dict_dir = args.dict_dir or args.out_dir or os.path.commonpath(
+            [os.path.dirname(os.path.abspath(output_path(p, rel, None, 'encrypt'))) for p, rel in items])
+        os.makedirs(dict_dir, exist_ok=True)
+        try:
+            print(f"shared dictionary -> {save_dictionary(zdict, dict_dir, session)}")
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+
+    def process(item):
+        path, rel = item
+        if args.command == 'decrypt' and path.endswith(DICT_SUFFIX):
+            print(f"{path}: skipped, a shared dictionary is loaded by the files that use it")
+            return
+        if args.command == 'decrypt' and volume_base(path):
+            # A .NNN name may be any file; the header says whether it is a volume and which one
+            number = inspect_header(path).get('volume')
+            if number and number > 1:
+                print(f"{path}: skipped, volume {number} is read along with the set's first volume")
+                return
+            if number:
+                rel = rel[:-4]
+        out = output_path(path, rel, args.out_dir, args.command)
+        resuming = args.command == 'encrypt' and args.resume and os.path.exists(out + JOURNAL_SUFFIX)
+        volumes = args.command == 'encrypt' and args.volume_size
+        if os.path.exists(volume_path(out, 1) if volumes else out) and not args.force and not resuming:
+            raise FileExistsError(f"{volume_path(out, 1) if volumes else out} exists (use --force to overwrite)")
+        if os.path.dirname(out):
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+        if args.command == 'encrypt':
+            paths = encrypt_file(path, out, session, args.comp, args.chunk_size, workers, index=args.index,
+                                 resume=args.resume, volume_size=args.volume_size, zdict=zdict, cipher=args.cipher,
+                                 spare_slots=args.spare_slots)
+            if paths:
+                out = f"{paths[0]} .. {paths[-1]}" if len(paths) > 1 else paths[0]
+        elif args.range:
+            decrypt_range_file(path, out, *args.range, session, workers)
+        else:
+            decrypt_file(path, out, session, workers, dict_dirs=[args.dict_dir] + dict_search_path(path) if args.dict_dir else None)
+        print(f"{path} -> {out}")
+    return 1 if run_jobs(process, items, args.jobs) else 0
+
+# --- GUI ---
+POLL_MS = 100
+
+class Cancelled(Exception):
+    pass
+
+class App:
+    # Jobs run on a worker thread that posts progress to a queue; the Tk thread drains it every
+    # POLL_MS, so the window stays responsive and Cancel takes effect at the next chunk.
+    def __init__(self):
+        import tkinter as tk
+        from tkinter import filedialog, messagebox, ttk
+        self.filedialog, self.messagebox = filedialog, messagebox
+        self.root = root = tk.Tk()
+        root.title("File Encryptor")
+        root.geometry("480x300")
+        tk.Label(root, text="Password:").pack(anchor='w', padx=10, pady=(10,0))
+        self.pw = tk.Entry(root, show='*', width=40)
+        self.pw.pack(padx=10)
+        tk.Label(root, text="Compression:").pack(anchor='w', padx=10, pady=(10,0))
+        self.comp_var = tk.StringVar(value='none')
+        for opt in (name for name, codec in CODECS.items() if codec.available()):
+            tk.Radiobutton(root, text=opt, variable=self.comp_var, value=opt).pack(anchor='w', padx=20)
+        self.bar = ttk.Progressbar(root, maximum=100)
+        self.bar.pack(fill='x', padx=10, pady=(10,0))
+        self.status = tk.Label(root, text="")
+        self.status.pack(anchor='w', padx=10)
+        self.encrypt_button = tk.Button(root, text="Encrypt file", command=self.encrypt_action)
+        self.encrypt_button.pack(side='left', padx=20, pady=10)
+        self.decrypt_button = tk.Button(root, text="Decrypt file", command=self.decrypt_action)
+        self.decrypt_button.pack(side='right', padx=20, pady=10)
+        self.cancel_button = tk.Button(root, text="Cancel", command=self.cancel_action, state='disabled')
+        self.cancel_button.pack(side='left', expand=True, pady=10)
+        root.protocol("WM_DELETE_WINDOW", self.close)
+        self.events = queue.Queue()
+        self.cancel = threading.Event()
+        self.worker = None
+
+    def mainloop(self):
+        self.root.mainloop()
+
+    def encrypt_action(self):
+        infile = self.filedialog.askopenfilename(title="Select file to encrypt")
+        if not infile: return
+        outfile = self.filedialog.asksaveasfilename(title="Save encrypted file as", defaultextension=".enc")
+        if not outfile: return
+        password, comp = self.pw.get(), self.comp_var.get()
+        self.start("Encrypted", infile, outfile, lambda report: encrypt_file(infile, outfile, password, comp, progress=report))
+
+    def decrypt_action(self):
+        infile = self.filedialog.askopenfilename(title="Select file to decrypt", filetypes=[("Encrypted files","*.enc"),("All files","*.*")])
+        if not infile: return
+        outfile = self.filedialog.asksaveasfilename(title="Save decrypted file as")
+        if not outfile: return
+        password = self.pw.get()
+        self.start("Decrypted", infile, outfile, lambda report: decrypt_file(infile, outfile, password, progress=report))
+
+    def start(self, verb, infile, outfile, job):
+        # job(report) runs on the worker; report raises Cancelled once Cancel was pressed, which
+        # encrypt_file/decrypt_file treat like any failure and remove the partial output
+        self.total = max(1, os.path.getsize(infile))
+        self.started = time.perf_counter()
+        self.cancel.clear()
+        self.set_busy(True)
+        self.show_progress(0)
+
+        def report(done):
+            if self.cancel.is_set():
+                raise Cancelled()
+            self.events.put(('progress', done))
+
+        def work():
+            try:
+                job(report)
+            except Cancelled:
+                self.events.put(('cancelled', None))
+            except Exception as e:
+                self.events.put(('error', str(e)))
+            else:
+                self.events.put(('done', f"{verb} to {outfile}"))
+        self.worker = threading.Thread(target=work, daemon=True)
+        self.worker.start()
+        self.root.after(POLL_MS, self.poll)
+
+    def poll(self):
+        done = None
+        while True:
+            try:
+                kind, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind != 'progress':
+                return self.finish(kind, value)
+            done = value
+        if done is not None:
+            self.show_progress(done)
+        self.root.after(POLL_MS, self.poll)
+
+    def show_progress(self, done):
+        elapsed = time.perf_counter() - self.started
+        rate = done / elapsed if elapsed > 0 else 0
+        text = f"{done / 1e6:.1f} of {self.total / 1e6:.1f} MB"
+        if rate:
+            eta = max(0, self.total - done) / rate
+            text += f"   {rate / 1e6:.1f} MB/s   {int(eta // 60)}:{int(eta % 60):02d} left"
+        self.bar['value'] = min(100, 100 * done / self.total)
+        self.status['text'] = text
+
+    def finish(self, kind, value):
+        self.set_busy(False)
+        if kind == 'done':
+            self.bar['value'] = 100
+            self.status['text'] = f"Done in {time.perf_counter() - self.started:.1f} s"
+            self.messagebox.showinfo("Done", value)
+        elif kind == 'cancelled':
+            self.bar['value'] = 0
+            self.status['text'] = "Cancelled; partial output removed"
+        else:
+            self.bar['value'] = 0
+            self.status['text'] = ""
+            self.messagebox.showerror("Error", value)
+
+    def set_busy(self, busy):
+        for button in (self.encrypt_button, self.decrypt_button):
+            button['state'] = 'disabled' if busy else 'normal'
+        self.cancel_button['state'] = 'normal' if busy else 'disabled'
+
+    def cancel_action(self):
+        self.cancel.set()
+        self.cancel_button['state'] = 'disabled'
+        self.status['text'] = "Cancelling..."
+
+    def close(self):
+        # Closing mid-job cancels it first, so no partial output is left behind
+        if self.worker and self.worker.is_alive():
+            self.cancel_action()
+            self.root.after(POLL_MS, self.close)
+            return
+        self.root.destroy()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main())
+    App().mainloop()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# Benchmarks for EncryptCompress: scrypt, AES-GCM and ChaCha20-Poly1305 frames, every codec on
+# synthetic corpora, and whole-file encrypt/decrypt across chunk sizes and worker counts. Each case
+# runs in a fresh interpreter so its peak RSS is its own. Results go to JSON and can be checked
+# against a baseline.
+import json, os, platform, random, subprocess, sys, time, zlib
+import EncryptCompress as ec
+
+CORPORA = ('random', 'text', 'logs', 'media')
+MIN_TIME = 0.2          # seconds a timed round must last; short operations are looped until it does
+PIECE = 1 << 20         # corpora are generated and written in pieces of this size
+CODEC_SAMPLE = 16 << 20 # largest input the codec-only cases compress in memory
+SALT = bytes(range(ec.SALT_LEN))   # fixed, so encrypt and decrypt children share one master key
+
+def default_codecs():
+    specs = ['none', 'gzip:1', 'gzip:6', 'bz2:9', 'lzma:6', 'auto']
+    if ec.CODECS['zstd'].available():
+        specs.append('zstd:3')
+    if ec.CODECS['lz4'].available():
+        specs.append('lz4:0')
+    return ','.join(specs)
+
+# --- Corpora ---
+def text_lines(rng):
+    # Zipf-distributed pseudo-words, so text compresses roughly like prose
+    vocab = [''.join(rng.choices('etaoinshrdlucmfwypvbgkjqxz', k=rng.randint(2, 9))) for _ in range(2000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocab))]
+    return [' '.join(rng.choices(vocab, weights, k=rng.randint(6, 16))).capitalize() + '.\n' for _ in range(4096)]
+
+def log_lines(rng):
+    components = ['api', 'auth', 'db', 'cache', 'worker', 'scheduler']
+    paths = ['/api/v1/' + p for p in ('users', 'orders', 'items', 'search', 'login', 'health')]
+    return [f"{rng.choice(['INFO', 'INFO', 'INFO', 'DEBUG', 'WARN', 'ERROR'])} [{rng.choice(components)}] "
+            f"request_id={rng.getrandbits(64):016x} user={rng.randint(1, 50000)} method={rng.choice(['GET', 'POST'])} "
+            f"path={rng.choice(paths)} status={rng.choice([200, 200, 200, 201, 404, 500])} "
+            f"latency_ms={rng.expovariate(1 / 40):.1f}\n" for _ in range(4096)]
+
+def corpus_pieces(kind, size, seed=0):
+    # Yields deterministic pieces totalling size bytes
+    rng = random.Random(f"{kind}:{seed}")
+    lines = text_lines(rng) if kind in ('text', 'media') else log_lines(rng) if kind == 'logs' else None
+    t0, produced = 1_700_000_000.0, 0
+    while produced < size:
+        n = min(PIECE, size - produced)
+        if kind == 'random':
+            piece = rng.randbytes(n)
+        elif kind == 'logs':
+            picks = rng.choices(lines, k=n // 100 + 1)
+            piece = ''.join(f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t0 + i * 0.01))} {line}"
+                            for i, line in enumerate(picks, produced // 100)).encode()
+        elif kind == 'media':
+            # Deflated text behind a JPEG marker: high entropy, and 'auto' sees the magic
+            piece = b'\xff\xd8\xff\xe0' if not produced else b''
+            while len(piece) < n:
+                piece += zlib.compress(''.join(rng.choices(lines, k=2000)).encode(), 1)
+        else:
+            piece = ''.join(rng.choices(lines, k=n // 60 + 1)).encode()
+        while len(piece) < n:
+            piece += piece
+        yield piece[:n]
+        produced += n
+
+def corpus_path(work_dir, kind, size):
+    # Generated once per (kind, size) and reused by later runs
+    path = os.path.join(work_dir, 'corpus', f"{kind}-{size}")
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            for piece in corpus_pieces(kind, size):
+                f.write(piece)
+        os.replace(path + '.tmp', path)
+    return path
+
+# --- Cases (run in a child process) ---
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None   # Windows
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+def measure(fn, repeat):
+    # Best per-call seconds over repeat rounds
+    best = float('inf')
+    for _ in range(repeat):
+        calls = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(calls):
+                fn()
+            elapsed = time.perf_counter() - start
+            if elapsed >= MIN_TIME or calls >= 1 << 16:
+                break
+            calls *= 2
+        best = min(best, elapsed / calls)
+    return best
+
+def run_case(case):
+    op, repeat = case['op'], case['repeat']
+    base_rss = peak_rss_mb()
+    result = dict(case)
+    if op == 'kdf':
+        seconds = measure(lambda: ec.derive_key('benchmark', SALT, tuple(case['kdf'])), repeat)
+        size = out = None
+    elif op == 'cipher':
+        key, prefix = os.urandom(ec.KEY_LEN), os.urandom(ec.NONCE_PREFIX_LEN)
+        params = ec.STREAM_PARAMS.pack(ec.STREAM_MAGIC, ec.FORMAT_VERSION, 0, 0, 0, case['chunk_size'], prefix)
+        params += bytes([ec.CIPHERS[case['cipher']], 1])
+        data = os.urandom(case['chunk_size'])
+        frame = ec.seal_frame(key, params, prefix, 0, ec.FRAME_DATA, data)
+        head, body = bytes(frame[:ec.FRAME_HEAD.size]), bytes(frame[ec.FRAME_HEAD.size:])
+        if case['direction'] == 'encrypt':
+            seconds = measure(lambda: ec.seal_frame(key, params, prefix, 0, ec.FRAME_DATA, data), repeat)
+        else:
+            seconds = measure(lambda: ec.open_frame(key, params, prefix, 0, head, body[:-ec.TAG_LEN], body[-ec.TAG_LEN:]), repeat)
+        size, out = len(data), len(frame)
+    elif op in ('compress', 'decompress'):
+        with open(case['path'], 'rb') as f:
+            data = f.read(case['chunk_size'])
+        packed = ec.compress_bytes(data, case['comp'])
+        name = ec.parse_codec(case['comp'])[0]
+        if op == 'compress':
+            seconds = measure(lambda: ec.compress_bytes(data, case['comp']), repeat)
+        else:
+            seconds = measure(lambda: ec.decompress_bytes(packed, name), repeat)
+        size, out = len(data), len(packed)
+    else:
+        session = ec.KeySession('benchmark', salt=SALT)
+        session.master_key(SALT)   # the KDF has its own cases; keep it out of file timings
+        if op == 'encrypt':
+            seconds = measure(lambda: ec.encrypt_file(case['path'], case['out'], session, case['comp'],
+                                                      case['chunk_size'], case['workers']), repeat)
+        else:
+            seconds = measure(lambda: ec.decrypt_file(case['out'], case['out'] + '.dec', session, case['workers']), repeat)
+            os.remove(case['out'] + '.dec')
+        size, out = case['size'], os.path.getsize(case['out'])
+    result.update(seconds=seconds, base_rss_mb=base_rss, peak_rss_mb=peak_rss_mb())
+    if size is not None:
+        result.update(bytes=size, mb_s=round(size / seconds / 1e6, 2) if seconds else None, ratio=round(out / max(size, 1), 4))
+    return result
+
+def spawn(case):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)],
+                          capture_output=True, text=True)
+    if proc.returncode:
+        return dict(case, error=(proc.stderr.strip().splitlines() or ['failed'])[-1])
+    return json.loads(proc.stdout)
+
+# --- Matrix ---
+def case_name(case):
+    parts = [case['op']]
+    for key in ('cipher', 'direction', 'corpus', 'size', 'comp', 'chunk_size', 'workers', 'kdf'):
+        if key in case:
+            value = case[key]
+            parts.append(':'.join(map(str, value)) if key == 'kdf' else f"{key[0]}={value}" if key in ('chunk_size', 'workers') else str(value))
+    return '/'.join(parts)
+
+def plan(args):
+    # Yields cases in run order; each encrypt case is followed by the decrypt of its output
+    def case(**fields):
+        fields['repeat'] = args.repeat
+        fields['name'] = case_name(fields)
+        return fields
+    if 'kdf' in args.ops:
+        for kdf in args.kdf:
+            yield case(op='kdf', kdf=list(kdf))
+    if 'cipher' in args.ops:
+        for cipher in ec.CIPHERS:
+            for cs in args.chunk_sizes:
+                for direction in ('encrypt', 'decrypt'):
+                    yield case(op='cipher', cipher=cipher, direction=direction, chunk_size=cs)
+    if 'codec' in args.ops:
+        size = min(max(args.sizes), CODEC_SAMPLE)
+        for corpus in args.corpora:
+            path = corpus_path(args.work_dir, corpus, size)
+            for comp in args.codecs:
+                for cs in args.chunk_sizes:
+                    for op in ('compress', 'decompress'):
+                        yield case(op=op, corpus=corpus, comp=comp, chunk_size=min(cs, size), path=path)
+    if 'file' in args.ops:
+        out = os.path.join(args.work_dir, 'out.enc')
+        for corpus in args.corpora:
+            for size in args.sizes:
+                path = corpus_path(args.work_dir, corpus, size)
+                for comp in args.codecs:
+                    for cs in args.chunk_sizes:
+                        for workers in args.workers:
+                            for op in ('encrypt', 'decrypt'):
+                                yield case(op=op, corpus=corpus, size=size, comp=comp, chunk_size=cs,
+                                           workers=workers, path=path, out=out)
+
+def compare(results, baseline, tolerance):
+    # Prints each case against the baseline and returns how many got slower or bigger than
+    # tolerance allows
+    old = {r['name']: r for r in baseline['results'] if 'error' not in r}
+    regressions = 0
+    print(f"\n{'case':<64} {'base s':>10} {'now s':>10} {'change':>8}")
+    for r in results:
+        b = old.get(r['name'])
+        if not b or 'error' in r:
+            continue
+        change = r['seconds'] / b['seconds'] - 1
+        flags = []
+        if change > tolerance:
+            flags.append('SLOWER')
+        if r.get('peak_rss_mb') and b.get('peak_rss_mb') and r['peak_rss_mb'] > b['peak_rss_mb'] * (1 + tolerance):
+            flags.append(f"RSS {b['peak_rss_mb']}->{r['peak_rss_mb']} MB")
+        if r.get('ratio') and b.get('ratio') and r['ratio'] > b['ratio'] * (1 + tolerance):
+            flags.append(f"ratio {b['ratio']}->{r['ratio']}")
+        regressions += bool(flags)
+        print(f"{r['name']:<64} {b['seconds']:>10.4g} {r['seconds']:>10.4g} {change:>+8.1%} {' '.join(flags)}")
+    return regressions
+
+def host_info():
+    import Crypto
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'cpus': os.cpu_count(), 'pycryptodome': Crypto.__version__,
+            'codecs': [name for name, codec in ec.CODECS.items() if codec.available()]}
+
+def size_list(text):
+    return [ec.parse_size(s) for s in text.split(',')]
+
+def build_parser():
+    import argparse
+    p = argparse.ArgumentParser(prog='encryptcompress-bench', description="Benchmark EncryptCompress on synthetic corpora")
+    p.add_argument('--ops', default='kdf,cipher,codec,file', type=lambda t: t.split(','),
+                   help="kdf, cipher (AES-GCM and ChaCha20-Poly1305 frames), codec (compress_bytes/decompress_bytes) "
+                        "and file (encrypt_file/decrypt_file)")
+    p.add_argument('--corpora', default=','.join(CORPORA), type=lambda t: t.split(','), help=', '.join(CORPORA))
+    p.add_argument('--sizes', default='1K,1M,16M', type=size_list, help="corpus sizes for file cases, e.g. 1K,64M,4G")
+    p.add_argument('--codecs', default=default_codecs(), type=lambda t: t.split(','), help="codec specs")
+    p.add_argument('--chunk-sizes', default='1M', type=size_list)
+    p.add_argument('--workers', default=f"1,{ec.WORKERS}", type=lambda t: [int(w) for w in t.split(',')])
+    p.add_argument('--kdf', default=[ec.DEFAULT_KDF], action='append', type=ec.parse_kdf, help="scrypt N:r:p (repeatable)")
+    p.add_argument('--repeat', type=int, default=3, help="rounds per case; the fastest counts")
+    p.add_argument('--work-dir', default='bench-data', help="where corpora are generated and kept")
+    p.add_argument('-o', '--output', help="write results as JSON here")
+    p.add_argument('--baseline', help="compare against an earlier JSON output; exits 1 on regressions")
+    p.add_argument('--tolerance', type=float, default=0.10, help="allowed slowdown/growth vs the baseline (default 0.10)")
+    p.add_argument('--run-case', help=argparse.SUPPRESS)
+    return p
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return 0
+    if len(args.kdf) > 1:
+        args.kdf = args.kdf[1:]   # explicit --kdf values replace the default
+    for spec in args.codecs:
+        ec.parse_codec(spec)
+    results = []
+    try:
+        for case in plan(args):
+            r = spawn(case)
+            r.pop('path', None)
+            r.pop('out', None)
+            results.append(r)
+            if 'error' in r:
+                print(f"{r['name']:<64} ERROR {r['error']}", file=sys.stderr)
+            else:
+                rate = f"{r['mb_s']:>9.1f} MB/s" if r.get('mb_s') is not None else f"{1 / r['seconds']:>9.1f} /s  "
+                print(f"{r['name']:<64} {rate}  ratio {r.get('ratio', '-')!s:<7} rss {r['peak_rss_mb']} MB", flush=True)
+    finally:
+        out = os.path.join(args.work_dir, 'out.enc')
+        if os.path.exists(out):
+            os.remove(out)
+    report = {'meta': host_info(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    failed = any('error' in r for r in results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        print(f"{regressions} regressions" if regressions else "no regressions")
+        failed = failed or regressions > 0
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())